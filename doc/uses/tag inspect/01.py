@@ -14,10 +14,10 @@ import webbrowser
 OUTPUT_PATH=R"X:\Data Analysis\SCOTT\SWHLab development\phasic2"
 
 def tagInspect(abf,saveToo=False): #TODO: put in ABF class?
-    if len(abf.comment_tags)<2:
+    if len(abf.tags)<2:
         warnings.warn("no tags in ABF!")
         return
-    S1,S2=abf.comment_sweeps[-2],abf.comment_sweeps[-1]
+    S1,S2=abf.tags.sweeps[-2],abf.tags.sweeps[-1]
 
     nSweeps = 20
     vertOffset = 50
@@ -75,7 +75,7 @@ if __name__=="__main__":
             fname=os.path.join(abfPath,fname)
             if os.stat(fname).st_size/10**6>10: # only do files > ~10MB
                 abf=swhlab.ABF(fname)
-                if len(abf.comment_sweeps)<2:
+                if len(abf.tags)<2:
                     print("SKIP:",fname)
                 else:
                     good.append(fname)
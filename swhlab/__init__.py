@@ -3,7 +3,8 @@ SWHLab is a python module intended to provide easy access to high level ABF
 file opeartions to aid analysis of whole-cell patch-clamp electrophysiological
 recordings. Although graphs can be interactive, the default mode is to output
 PNGs and generate flat file HTML indexes to allow data browsing through any
-browser on the network. Direct ABF access was provided by the NeoIO module.
+browser on the network. Direct ABF access is provided by swhlab.reader (a
+memory-mapped ABF1/ABF2 reader) with the NeoIO module as a fallback.
 
 * if a site-packages warning is thrown, force use of developmental version by:
       sys.path.insert(0,'../')
@@ -45,7 +46,32 @@ loglevel_ERROR=logging.ERROR
 loglevel=loglevel_QUIET # change this at will
 
 from swhlab.version import __version__
-from swhlab.core import ABF
-from swhlab.plotting.core import ABFplot as PLOT
-from swhlab.analysis.ap import AP
-from swhlab.indexing import imaging
\ No newline at end of file
+
+# Everything else is imported the first time it's used, so scripts which only
+# read headers (swhlab.ABFHeader) don't wait for matplotlib, neo, etc.
+LAZY_ATTRIBUTES={'ABF':('swhlab.core','ABF'),
+                 'ABFHeader':('swhlab.reader','ABFHeader'),
+                 'validate':('swhlab.reader','validate'),
+                 'PLOT':('swhlab.plotting.core','ABFplot'),
+                 'AP':('swhlab.analysis.ap','AP'),
+                 'imaging':('swhlab.indexing.imaging',None)}
+
+def __getattr__(name):
+    """import attributes (and submodules) the first time they're used."""
+    import importlib
+    if name in LAZY_ATTRIBUTES:
+        moduleName,attribute=LAZY_ATTRIBUTES[name]
+        value=importlib.import_module(moduleName)
+        if attribute:
+            value=getattr(value,attribute)
+    elif name.startswith('_'):
+        raise AttributeError("module 'swhlab' has no attribute '%s'"%name)
+    else:
+        try:
+            value=importlib.import_module('swhlab.'+name) # a submodule
+        except ModuleNotFoundError as e:
+            if e.name!='swhlab.'+name:
+                raise # the submodule exists but something it needs doesn't
+            raise AttributeError("module 'swhlab' has no attribute '%s'"%name)
+    globals()[name]=value # so this only happens once
+    return value
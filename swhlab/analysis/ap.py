@@ -24,10 +24,11 @@ import os
 ms=.001 # easy access to a millisecond
 
 class AP:
-    def __init__(self,abf):
+    def __init__(self,abf,channel=None):
         """
         Load an ABF and get ready to do AP detection.
         After detect(), all AP data is stored as a list of dicts in AP.APs
+        Detection uses the ABF's current channel unless another is given.
         """
         self.log = logging.getLogger("swhlab AP")
         self.log.setLevel(swhlab.loglevel)
@@ -41,6 +42,7 @@ class AP:
             self.log.debug("filename given, turning it into an ABF class")
             abf=ABF(abf)
         self.abf=abf
+        self.channel=abf.channel if channel is None else channel
 
         # detection settings
         self.detect_over = 50 # must be at least this (mV/ms)
@@ -68,6 +70,7 @@ class AP:
         """runs AP detection on every sweep."""
         self.log.info("initializing AP detection on all sweeps...")
         t1=cm.timeit()
+        self.abf.derived("derivative",channel=self.channel) # all sweeps at once
         for sweep in range(self.abf.sweeps):
             self.detectSweep(sweep)
         self.log.info("AP analysis of %d sweeps found %d APs (completed in %s)",
@@ -89,16 +92,17 @@ class AP:
                 self.APs.remove(None)
         self.log.debug("initiating AP detection (%d already in memory)",len(self.APs))
 
-        self.abf.derivative=True
-        self.abf.setsweep(sweep)
+        thisSweep=self.abf.getSweep(sweep,self.channel) # doesn't disturb the ABF
+        sweepY,sweepD=thisSweep.Y,thisSweep.D
+        pointsPerMs,pointsPerSec=thisSweep.pointsPerMs,thisSweep.pointsPerSec
 
         # detect potential AP (Is) by a dV/dT threshold crossing
-        Is = cm.where_cross(self.abf.sweepD,self.detect_over)
+        Is = cm.where_cross(sweepD,self.detect_over)
         self.log.debug("initial AP detection: %d APs"%len(Is))
 
         # eliminate APs where dV/dT doesn't cross below -10 V/S within 2 ms
         for i,I in enumerate(Is):
-            if np.min(self.abf.sweepD[I:I+2*self.abf.pointsPerMs])>-10:
+            if np.min(sweepD[I:I+2*pointsPerMs])>-10:
                 Is[i]=0
         Is=Is[np.nonzero(Is)]
         self.log.debug("after lower threshold checking: %d APs"%len(Is))
@@ -106,7 +110,7 @@ class AP:
         # walk 1ms backwards and find point of +10 V/S threshold crossing
         for i,I in enumerate(Is):
             stepBack=0
-            while(self.abf.sweepD[I-stepBack])>10 and stepBack/self.abf.pointsPerMs<1: #2ms max
+            while(sweepD[I-stepBack])>10 and stepBack/pointsPerMs<1: #2ms max
                 stepBack+=1
             Is[i]-=stepBack
 
@@ -114,30 +118,31 @@ class AP:
         sweepAPs=[]
         for i,I in enumerate(Is):
             try:
-                timeInSweep=I/self.abf.pointsPerSec
+                timeInSweep=I/pointsPerSec
                 if timeInSweep<self.detect_time1 or timeInSweep>self.detect_time2:
                     continue # skip because it's not within the marks
                 ap={} # create the AP entry
                 ap["sweep"]=sweep # number of the sweep containing this AP
+                ap["channel"]=self.channel # channel the AP was detected in
                 ap["I"]=I # index sweep point of start of AP (10 mV/ms threshold crossing)
-                ap["Tsweep"]=I/self.abf.pointsPerSec # time in the sweep of index crossing (sec)
-                ap["T"]=ap["Tsweep"]+self.abf.sweepInterval*sweep # time in the experiment
-                ap["Vthreshold"]=self.abf.sweepY[I] # threshold at rate of -10mV/ms
+                ap["Tsweep"]=I/pointsPerSec # time in the sweep of index crossing (sec)
+                ap["T"]=ap["Tsweep"]+thisSweep.length*sweep # time in the experiment
+                ap["Vthreshold"]=sweepY[I] # threshold at rate of -10mV/ms
 
                 # determine how many points from the start dV/dt goes below -10 (from a 5ms chunk)
-                chunk=self.abf.sweepD[I:I+5*self.abf.pointsPerMs] # give it 5ms to cross once
+                chunk=sweepD[I:I+5*pointsPerMs] # give it 5ms to cross once
                 I_toNegTen=np.where(chunk<-10)[0][0]
-                chunk=self.abf.sweepD[I+I_toNegTen:I+I_toNegTen+10*self.abf.pointsPerMs] # give it 30ms to cross back
+                chunk=sweepD[I+I_toNegTen:I+I_toNegTen+10*pointsPerMs] # give it 30ms to cross back
                 if not max(chunk)>-10:
                     self.log.debug("skipping unreal AP at T=%f"%ap["T"])
                     self.log.error("^^^ can you confirm this is legit?")
                     continue # probably a pre-AP "bump" to be ignored
                 I_recover=np.where(chunk>-10)[0][0]+I_toNegTen+I # point where trace returns to above -10 V/S
                 ap["dVfastIs"]=[I,I_recover] # span of the fast component of the dV/dt trace
-                ap["dVfastMS"]=(I_recover-I)/self.abf.pointsPerMs # time (in ms) of this fast AP component
+                ap["dVfastMS"]=(I_recover-I)/pointsPerMs # time (in ms) of this fast AP component
 
                 # determine derivative min/max from a 2ms chunk which we expect to capture the fast AP
-                chunk=self.abf.sweepD[ap["dVfastIs"][0]:ap["dVfastIs"][1]]
+                chunk=sweepD[ap["dVfastIs"][0]:ap["dVfastIs"][1]]
                 ap["dVmax"]=np.max(chunk)
                 ap["dVmaxI"]=np.where(chunk==ap["dVmax"])[0][0]+I
                 ap["dVmin"]=np.min(chunk)
@@ -148,13 +153,13 @@ class AP:
                     continue
 
                 # before determining AP shape stats, see where trace recovers to threshold
-                chunkSize=self.abf.pointsPerMs*10 #AP shape may be 10ms
+                chunkSize=pointsPerMs*10 #AP shape may be 10ms
                 if len(Is)-1>i and Is[i+1]<(I+chunkSize): # if slow AP runs into next AP
                     chunkSize=Is[i+1]-I # chop it down
-                if chunkSize<(self.abf.pointsPerMs*2):
+                if chunkSize<(pointsPerMs*2):
                     continue # next AP is so soon, it's >500 Hz. Can't be real.
                 ap["VslowIs"]=[I,I+chunkSize] # time range of slow AP dynamics
-                chunk=self.abf.sweepY[I:I+chunkSize]
+                chunk=sweepY[I:I+chunkSize]
 
                 # determine AP peak and minimum
                 ap["Vmax"]=np.max(chunk)
@@ -173,14 +178,14 @@ class AP:
                     self.log.error("HP too close for comfort!")
                     self.log.error("-------------------------------")
 
-                ap["msRiseTime"]=(ap["VmaxI"]-I)/self.abf.pointsPerMs # time from threshold to peak
-                ap["msFallTime"]=(ap["VminI"]-ap["VmaxI"])/self.abf.pointsPerMs # time from peak to nadir
+                ap["msRiseTime"]=(ap["VmaxI"]-I)/pointsPerMs # time from threshold to peak
+                ap["msFallTime"]=(ap["VminI"]-ap["VmaxI"])/pointsPerMs # time from peak to nadir
 
                 # determine halfwidth
                 ap["Vhalf"]=np.average([ap["Vmax"],ap["Vthreshold"]]) # half way from threshold to peak
                 ap["VhalfI1"]=cm.where_cross(chunk,ap["Vhalf"])[0]+I # time it's first crossed
                 ap["VhalfI2"]=cm.where_cross(-chunk,-ap["Vhalf"])[1]+I # time it's second crossed
-                ap["msHalfwidth"]=(ap["VhalfI2"]-ap["VhalfI1"])/self.abf.pointsPerMs # time between crossings
+                ap["msHalfwidth"]=(ap["VhalfI2"]-ap["VhalfI1"])/pointsPerMs # time between crossings
 
                 # AP error checking goes here
                 # TODO:
@@ -196,7 +201,6 @@ class AP:
 
         self.log.debug("finished analyzing sweep. Found %d APs",len(sweepAPs))
         self.APs.extend(sweepAPs)
-        self.abf.derivative=False # leave it how we started
 
     ### ANALYSIS
 
@@ -23,6 +23,7 @@ import numpy as np
 
 import swhlab
 from swhlab import ABF
+from swhlab.core import cachedABF
 from swhlab.plotting import ABFplot
 from swhlab.plotting.core import frameAndSave
 from swhlab.analysis.ap import AP
@@ -42,7 +43,7 @@ SQUARESIZE=8
 
 def proto_unknown(theABF):
     """protocol: unknown."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as an unknown protocol")
     plot=ABFplot(abf)
     plot.rainbow=False
@@ -54,7 +55,7 @@ def proto_unknown(theABF):
     frameAndSave(abf,"UNKNOWN")
 
 def proto_0101(theABF):
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as an IC tau")
     #plot=ABFplot(abf)
 
@@ -81,7 +82,7 @@ def proto_0101(theABF):
 
 def proto_0111(theABF):
     """protocol: IC ramp for AP shape analysis."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as an IC ramp")
 
     # AP detection
@@ -135,7 +136,7 @@ def proto_0111(theABF):
 
 def proto_gain(theABF,stepSize=25,startAt=-100):
     """protocol: gain function of some sort. step size and start at are pA."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as an IC ramp")
     plot=ABFplot(abf)
     plot.kwargs["lw"]=.5
@@ -224,7 +225,7 @@ def proto_0114(theABF):
 
 def proto_0201(theABF):
     """protocol: membrane test."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as a membrane test")
     plot=ABFplot(abf)
     plot.figure_height,plot.figure_width=SQUARESIZE/2,SQUARESIZE/2
@@ -237,7 +238,7 @@ def proto_0201(theABF):
 
 def proto_0202(theABF):
     """protocol: MTIV."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as MTIV")
     plot=ABFplot(abf)
     plot.figure_height,plot.figure_width=SQUARESIZE,SQUARESIZE
@@ -246,10 +247,9 @@ def proto_0202(theABF):
     plot.figure_sweeps()
 
     # frame to uppwer/lower bounds, ignoring peaks from capacitive transients
-    abf.setsweep(0)
-    plt.axis([None,None,abf.average(.9,1)-100,None])
-    abf.setsweep(-1)
-    plt.axis([None,None,None,abf.average(.9,1)+100])
+    values,labels=abf.measure([(.9,1)],sweeps=[0,abf.sweeps-1])
+    plt.axis([None,None,values[0,0,0]-100,None])
+    plt.axis([None,None,None,values[1,0,0]+100])
 
     # save it
     plt.tight_layout()
@@ -258,7 +258,7 @@ def proto_0202(theABF):
 
 def proto_0203(theABF):
     """protocol: vast IV."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as a fast IV")
     plot=ABFplot(abf)
     plot.title=""
@@ -272,10 +272,7 @@ def proto_0203(theABF):
     plt.subplot(122)
     plt.grid(alpha=.5)
     Xs=np.arange(abf.sweeps)*5-110
-    Ys=[]
-    for sweep in range(abf.sweeps):
-        abf.setsweep(sweep)
-        Ys.append(abf.average(m1,m2))
+    Ys=abf.measure([(m1,m2)])[0][:,0,0]
     plt.plot(Xs,Ys,'.-',ms=10)
     plt.axvline(-70,color='r',ls='--',lw=2,alpha=.5)
     plt.axhline(0,color='r',ls='--',lw=2,alpha=.5)
@@ -289,7 +286,7 @@ def proto_0203(theABF):
 
 def proto_0204(theABF):
     """protocol: Cm ramp."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as Cm ramp")
     plot=ABFplot(abf)
     plot.figure_height,plot.figure_width=SQUARESIZE/2,SQUARESIZE/2
@@ -301,7 +298,7 @@ def proto_0204(theABF):
 
 def proto_0222(theABF):
     """protocol: VC sine sweep."""
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as VC sine sweep")
     plot=ABFplot(abf)
     plot.figure_height,plot.figure_width=SQUARESIZE/2,SQUARESIZE/2
@@ -316,7 +313,7 @@ def proto_0302(theABF):
 def proto_0303(theABF):
     """protocol: repeated IC ramps."""
 
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as a halorhodopsin (2s pulse)")
 
     # show average voltage
@@ -325,9 +322,10 @@ def proto_0303(theABF):
 
     # show stacked sweeps
     plt.figure(figsize=(8,8))
+    taggedSweeps=set(abf.tags.sweeps)
     for sweep in abf.setsweeps():
         color='b'
-        if sweep in np.array(abf.comment_sweeps,dtype=int):
+        if sweep in taggedSweeps:
             color='r'
         plt.plot(abf.sweepX2,abf.sweepY+100*sweep,color=color,alpha=.5)
     plt.margins(0,.01)
@@ -372,18 +370,15 @@ def proto_0303(theABF):
 def proto_0304(theABF):
     """protocol: repeated IC steps."""
 
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as repeated current-clamp step")
 
     # prepare for AP analysis
     ap=AP(abf)
 
     # calculate rest potential
-    avgVoltagePerSweep = [];
-    times = []
-    for sweep in abf.setsweeps():
-        avgVoltagePerSweep.append(abf.average(0,3))
-        times.append(abf.sweepStart/60)
+    avgVoltagePerSweep = abf.measure([(0,3)])[0][:,0,0]
+    times = abf.sweepStarts/60
 
     # detect only step APs
     M1,M2=3.15,4.15
@@ -426,16 +421,17 @@ def proto_0304(theABF):
 
 
 def proto_0314(theABF):
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing a cosine + ramp protocol")
 
-    if len(abf.comment_sweeps>0):
+    if len(abf.tags):
         # comments exist, so graph the average sweep before/after the first comment
         sweepsToAverage=10
-        baselineSweep1=max(0, abf.comment_sweeps[0]-sweepsToAverage)
-        baselineSweep2=abf.comment_sweeps[0]
-        drugSweep1=abf.comment_sweeps[0]+1
-        drugSweep2=min(abf.sweeps-1,abf.comment_sweeps[0]+1+sweepsToAverage)
+        window=abf.tags.sweepWindow(0,sweepsToAverage)
+        tagSweep=abf.tags.sweeps[0]
+        baselineSweep1,baselineSweep2=window[0],tagSweep
+        drugSweep1=tagSweep+1
+        drugSweep2=min(abf.sweeps-1,tagSweep+1+sweepsToAverage)
 
         plt.figure(figsize=(16,4))
         plt.grid(ls='--',alpha=.5)
@@ -456,11 +452,8 @@ def proto_0314(theABF):
     ap=AP(abf)
 
     # calculate rest potential
-    avgVoltagePerSweep = [];
-    times = []
-    for sweep in abf.setsweeps():
-        avgVoltagePerSweep.append(abf.average(0,2.25))
-        times.append(abf.sweepStart/60)
+    avgVoltagePerSweep = abf.measure([(0,2.25)])[0][:,0,0]
+    times = abf.sweepStarts/60
 
     # detect only cos APs
     M1,M2=2.25,4.5
@@ -524,7 +517,7 @@ def proto_0502(theABF):
     BLS_average_stack(theABF)
 
 def proto_0911(theABF):
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as paired pulse stimulation with various increasing ISIs")
     plt.figure(figsize=(8,8))
     M1,M2=2.2,2.4
@@ -554,7 +547,7 @@ def proto_0911(theABF):
     plt.close('all')
 
 def proto_0912(theABF):
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as 40ms PPS experiment")
 
     BL1,BL2=1,2 # area for baseline
@@ -564,7 +557,6 @@ def proto_0912(theABF):
     Ip3=Ip2+(Ip2-Ip1) # distance after Ip2 to scan for the second peak
     pw=int(3/1000*abf.pointsPerSec) # pulse width in ms
     peakTimes,peak1heights,peak2heights,peakRatios,baselines,peakTransient=[],[],[],[],[],[]
-    ROI=None
     ROIpad=int(.02*abf.pointsPerSec)
 
     # calculate peak ratios and all that
@@ -585,11 +577,6 @@ def proto_0912(theABF):
         peak2heights.append(np.nanmin(peak2))
         baselines.append(baseline)
         peakRatios.append(peak2heights[-1]/peak1heights[-1])
-        thisROI=abf.sweepY[int(Ip1)-ROIpad:int(Ip3)+ROIpad]
-        if ROI is None:
-            ROI=thisROI.flatten()
-        else:
-            ROI=np.vstack((ROI,thisROI.flatten()))
     peakTimes=np.array(peakTimes)/60 # seconds to minutes
 
     # figure showing the averaged evoked response for certain time ranges
@@ -598,11 +585,16 @@ def proto_0912(theABF):
     plt.figure(figsize=(8,8))
     plt.grid(alpha=.4,ls='--')
     plt.axhline(0,alpha=.5,ls='--',lw=2,color='k')
+    t1,t2=(Ip1-ROIpad)/abf.pointsPerSec,(Ip3+ROIpad)/abf.pointsPerSec
+    I0=int(t1*abf.pointsPerSec) # first point of the averaged region
     for S2 in avgLocations:
         S1=S2-avgSweeps
-        AV=np.average(ROI[S1:S2],axis=0)
-        ER=np.std(ROI[S1:S2],axis=0)#/np.sqrt(len(ROI))
-        Xs=abf.sweepX[:len(AV)]
+        if S1>=abf.sweeps:
+            continue
+        stats=abf.sweepStats(range(S1,min(S2,abf.sweeps)),t1,t2,baseline=(BL1,BL2))
+        AV,ER,Xs=stats["mean"],stats["sd"],stats["X"]
+        for I in [Ip1,Ip2]:
+            AV[I-I0:I-I0+pw]=np.nan # blank out each pulse
         plt.fill_between(Xs,AV-ER,AV+ER,alpha=.1)
         plt.plot(Xs,AV,label="sweeps %d-%d"%(S1,S2))
     plt.legend()
@@ -671,7 +663,7 @@ def comment_lines(abf,label=True):
         plt.legend()
 
 def BLS_average_stack(theABF):
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     T1,T2=abf.epochTimes(2)
     padding=.1
     if abf.units=="mV":
@@ -718,25 +710,17 @@ def BLS_average_stack(theABF):
 def proto_avgRange(theABF,m1=None,m2=None):
     """experiment: generic VC time course experiment."""
 
-    abf=ABF(theABF)
+    abf=cachedABF(theABF)
     abf.log.info("analyzing as a fast IV")
     if m1 is None:
         m1=abf.sweepLength
     if m2 is None:
         m2=abf.sweepLength
 
-    I1=int(abf.pointsPerSec*m1)
-    I2=int(abf.pointsPerSec*m2)
-
     Ts=np.arange(abf.sweeps)*abf.sweepInterval
-    Yav=np.empty(abf.sweeps)*np.nan # average
-    Ysd=np.empty(abf.sweeps)*np.nan # standard deviation
-    #Yar=np.empty(abf.sweeps)*np.nan # area
-
-    for sweep in abf.setsweeps():
-        Yav[sweep]=np.average(abf.sweepY[I1:I2])
-        Ysd[sweep]=np.std(abf.sweepY[I1:I2])
-        #Yar[sweep]=np.sum(abf.sweepY[I1:I2])/(I2*I1)-Yav[sweep]
+    values,labels=abf.measure([(m1,m2)],['mean','std']) # NaN if I2<=I1
+    Yav=values[:,0,0] # average
+    Ysd=values[:,0,1] # standard deviation
 
     plot=ABFplot(abf)
     plt.figure(figsize=(SQUARESIZE*2,SQUARESIZE/2))
@@ -785,14 +769,13 @@ def analyze(fname=False,save=True,show=None):
         else:
             swhlab.plotting.core.IMAGE_SHOW=False
     #swhlab.plotting.core.IMAGE_SHOW=show
-    abf=ABF(fname) # ensure it's a class
+    abf=cachedABF(fname) # ensure it's a class (opened only once per run)
     print(">>>>> PROTOCOL >>>>>",abf.protocomment)
     runFunction="proto_unknown"
     if "proto_"+abf.protocomment in globals():
         runFunction="proto_"+abf.protocomment
     abf.log.debug("running %s()"%(runFunction))
     plt.close('all') # get ready
-    globals()[runFunction](abf) # run that function
     try:
         globals()[runFunction](abf) # run that function
     except:
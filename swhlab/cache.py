@@ -0,0 +1,229 @@
+"""
+On-disk cache of decoded ABF data, kept in the ./swhlab/ output folder.
+
+Decoding an integer ABF (or reading one through neo) means scaling every point
+of every sweep each time the file is opened. With the cache turned on, the
+decoded data of every channel (channels x sweeps x points) is saved once as a
+.npy file next to a small JSON file describing where it came from. Opening the
+ABF again just memory-maps that .npy file.
+
+The cache is keyed on the ABF's path, size, modification time, and a hash of
+its header, so editing or replacing an ABF invalidates its cache. The total
+size of a cache folder is capped at CACHE_MB, and the least recently used
+entries are deleted to make room.
+
+ABFs on slow network drives can also be copied into a local folder before
+they're read (see localCopy). Local copies are keyed on the remote path, size
+and modification time, and the folder is capped at LOCAL_MB the same way.
+"""
+
+import os
+import json
+import time
+import glob
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+CACHE_MB=2000 # maximum size (MB) of the cache in each output folder
+HEADER_BYTES=8192 # this much of the start of the ABF is hashed
+VERSION=1 # bump this to invalidate every existing cache
+LOCAL_MB=5000 # maximum size (MB) of a folder of local copies of ABFs
+
+log=logging.getLogger("swhlab cache")
+
+def fileKey(fname):
+    """return a dict which identifies an ABF file on disk."""
+    fname=os.path.abspath(fname)
+    stat=os.stat(fname)
+    with open(fname,'rb') as f:
+        headerHash=hashlib.md5(f.read(HEADER_BYTES)).hexdigest()
+    return {"version":VERSION,"path":fname,"size":stat.st_size,
+            "mtime":stat.st_mtime,"header":headerHash}
+
+def cachePaths(abf):
+    """return the (data, metadata) filenames of the cache of an ABF."""
+    return abf.outPre+"cache.npy",abf.outPre+"cache.json"
+
+def cacheMode(abf):
+    """return how an ABF keeps its data ("raw" samples, or a float dtype)."""
+    return "raw" if abf.raw else abf.dtype.name
+
+def load(abf):
+    """
+    return the cached data (channels x sweeps x points) of an ABF as a
+    copy-on-write memory map, or None if there's no valid cache for it.
+    """
+    fnameData,fnameMeta=cachePaths(abf)
+    if not os.path.exists(fnameData) or not os.path.exists(fnameMeta):
+        return None
+    try:
+        with open(fnameMeta) as f:
+            meta=json.load(f)
+        if meta['key']!=fileKey(abf.filename) or meta.get('mode')!=cacheMode(abf):
+            log.debug("cache of [%s] is out of date",abf.ID)
+            remove(fnameMeta)
+            remove(fnameData)
+            return None
+        data=np.load(fnameData,mmap_mode='c')
+        if list(data.shape)!=meta['shape']:
+            raise ValueError("cache shape doesn't match its metadata")
+    except Exception as e:
+        log.warning("ignoring bad cache of [%s] (%s)",abf.ID,e)
+        remove(fnameMeta)
+        remove(fnameData)
+        return None
+    meta['used']=time.time() # mark as recently used (for eviction)
+    _writeMeta(fnameMeta,meta)
+    log.debug("loaded cache of [%s]",abf.ID)
+    return data
+
+def save(abf,data):
+    """
+    save decoded data (channels x sweeps x points) of an ABF to its cache,
+    make room by evicting old entries, and return the saved data memory-mapped.
+    """
+    fnameData,fnameMeta=cachePaths(abf)
+    if not os.path.exists(abf.outFolder):
+        os.mkdir(abf.outFolder)
+    data=np.ascontiguousarray(data)
+    evict(abf.outFolder,data.nbytes)
+    np.save(fnameData+".tmp.npy",data) # write, then swap it in
+    os.replace(fnameData+".tmp.npy",fnameData)
+    meta={"key":fileKey(abf.filename),"shape":list(data.shape),
+          "dtype":str(data.dtype),"mode":cacheMode(abf),"used":time.time()}
+    _writeMeta(fnameMeta,meta)
+    log.debug("cached [%s] (%.01f MB)",abf.ID,data.nbytes/1e6)
+    return np.load(fnameData,mmap_mode='c')
+
+def loadArrays(abf,name):
+    """
+    return a dict of small arrays which saveArrays() cached for an ABF
+    (envelope pyramids, etc.), or None if they're missing or out of date.
+    """
+    fnameData=abf.outPre+name+"_cache.npz"
+    fnameMeta=fnameData[:-4]+".json"
+    if not os.path.exists(fnameData) or not os.path.exists(fnameMeta):
+        return None
+    try:
+        with open(fnameMeta) as f:
+            meta=json.load(f)
+        if meta['key']!=fileKey(abf.filename):
+            log.debug("cached %s of [%s] is out of date",name,abf.ID)
+            remove(fnameMeta)
+            remove(fnameData)
+            return None
+        with np.load(fnameData) as npz:
+            arrays=dict(npz)
+    except Exception as e:
+        log.warning("ignoring bad cached %s of [%s] (%s)",name,abf.ID,e)
+        remove(fnameMeta)
+        remove(fnameData)
+        return None
+    meta['used']=time.time()
+    _writeMeta(fnameMeta,meta)
+    return arrays
+
+def saveArrays(abf,name,arrays):
+    """cache a dict of small arrays for an ABF (see loadArrays)."""
+    fnameData=abf.outPre+name+"_cache.npz"
+    fnameMeta=fnameData[:-4]+".json"
+    if not os.path.exists(abf.outFolder):
+        os.mkdir(abf.outFolder)
+    nbytes=sum([x.nbytes for x in arrays.values()])
+    evict(abf.outFolder,nbytes)
+    np.savez(fnameData+".tmp.npz",**arrays) # write, then swap it in
+    os.replace(fnameData+".tmp.npz",fnameData)
+    _writeMeta(fnameMeta,{"key":fileKey(abf.filename),"used":time.time()})
+    log.debug("cached %s of [%s] (%.01f MB)",name,abf.ID,nbytes/1e6)
+
+def localPaths(fname,folder):
+    """return the (ABF, metadata) filenames of the local copy of an ABF."""
+    fname=os.path.abspath(fname)
+    pathHash=hashlib.md5(fname.encode()).hexdigest()[:12]
+    ID=os.path.splitext(os.path.basename(fname))[0]
+    fnameLocal=os.path.join(os.path.abspath(folder),"%s_%s_cache"%(ID,pathHash))
+    return fnameLocal+".abf",fnameLocal+".json"
+
+def localCopy(fname,folder):
+    """
+    return the filename of a local copy of an ABF (on a network drive),
+    copying it into the folder first if it isn't there or is out of date.
+    The folder is kept under LOCAL_MB by deleting the least recently used
+    copies. If the copy can't be made, the original filename is returned.
+    """
+    fname=os.path.abspath(fname)
+    fnameLocal,fnameMeta=localPaths(fname,folder)
+    stat=os.stat(fname)
+    key={"version":VERSION,"path":fname,"size":stat.st_size,"mtime":stat.st_mtime}
+    try:
+        with open(fnameMeta) as f:
+            meta=json.load(f)
+        if meta['key']==key and os.path.getsize(fnameLocal)==stat.st_size:
+            meta['used']=time.time()
+            _writeMeta(fnameMeta,meta)
+            log.debug("using local copy of [%s]",fname)
+            return fnameLocal
+    except (OSError,ValueError,KeyError):
+        pass # no local copy (or a broken one)
+    fnameTemp="%s.%d.tmp"%(fnameLocal,os.getpid())
+    try:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        evict(folder,stat.st_size,LOCAL_MB)
+        shutil.copyfile(fname,fnameTemp) # copy, then swap it in
+        os.replace(fnameTemp,fnameLocal)
+    except OSError as e:
+        log.warning("couldn't copy [%s] locally (%s)",fname,e)
+        remove(fnameTemp)
+        return fname
+    _writeMeta(fnameMeta,{"key":key,"used":time.time()})
+    log.debug("copied [%s] locally (%.01f MB)",fname,stat.st_size/1e6)
+    return fnameLocal
+
+def evict(folder,needBytes=0,maxMB=None):
+    """
+    delete the least recently used caches in a folder until its caches
+    (plus needBytes about to be written) fit within maxMB (CACHE_MB).
+    """
+    maxMB=CACHE_MB if maxMB is None else maxMB
+    entries=[]
+    for fnameMeta in glob.glob(os.path.join(folder,"*_cache.json")):
+        for extension in [".npy",".npz",".abf"]: # data, arrays, local copies
+            fnameData=fnameMeta[:-5]+extension
+            if os.path.exists(fnameData):
+                break
+        if not os.path.exists(fnameData):
+            remove(fnameMeta)
+            continue
+        try:
+            with open(fnameMeta) as f:
+                used=json.load(f)['used']
+        except Exception:
+            used=0 # unreadable metadata goes first
+        entries.append([used,os.path.getsize(fnameData),fnameMeta,fnameData])
+    total=sum([x[1] for x in entries])+needBytes
+    for used,size,fnameMeta,fnameData in sorted(entries):
+        if total<=maxMB*1e6:
+            break
+        log.debug("evicting cache [%s]",os.path.basename(fnameData))
+        remove(fnameMeta)
+        remove(fnameData)
+        total-=size
+
+def remove(fname):
+    """delete a file if it exists (cached data may be in use on Windows)."""
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+def _writeMeta(fname,meta):
+    """write metadata JSON without leaving a half-written file behind."""
+    try:
+        with open(fname+".tmp",'w') as f:
+            json.dump(meta,f)
+        os.replace(fname+".tmp",fname)
+    except OSError as e:
+        log.debug("couldn't update [%s] (%s)",fname,e)
@@ -9,6 +9,17 @@ import numpy as np
 import time
 import datetime
 import tempfile
+import collections
+import threading
+
+# how lowpass() and friends smooth: "kernel" (convolve with a gaussian
+# kernel) or "boxes" (a cascade of box filters, see smoothBoxes)
+SMOOTHER="kernel"
+
+# kernel_gaussian() remembers this many kernels, and convolve() remembers
+# the FFTs of those kernels (up to this many MB) so they're made only once
+KERNEL_CACHE=32
+SPECTRUM_MB=64
 
 ### numpy
 
@@ -19,34 +30,117 @@ def where_cross(data,threshold):
     Ds=Is[:-1]-Is[1:]+1
     return Is[np.where(Ds)[0]+1]
 
-def kernel_gaussian(size=100, sigma=None, forwardOnly=False):
+def kernel_gaussian(size=100, sigma=None, forwardOnly=False, dtype=float):
     """
     return a 1d gassuan array of a given size and sigma.
     If sigma isn't given, it will be 1/10 of the size, which is usually good.
     Note that this is fully numpy, and doesn't use scipy.
+    The last KERNEL_CACHE kernels are remembered, so the same array comes
+    back for the same arguments. It's read-only (copy it to change it).
     """
     if sigma is None:
         sigma=size/10
     size=int(size)
+    key=(size,float(sigma),bool(forwardOnly),np.dtype(dtype).str)
+    kernelCache.maxItems=KERNEL_CACHE
+    points=kernelCache.get(key)
+    if points is not None:
+        return points
     points=np.exp(-np.power(np.arange(size)-size/2,2)/(2*np.power(sigma,2)))
     if forwardOnly:
         points[:int(len(points)/2)]=0
-    return points/sum(points)
+    points=(points/sum(points)).astype(dtype)
+    points.flags.writeable=False
+    kernelCache[key]=points
+    return points
 
-def lowpass(data,filterSize=None):
+def kernelSpectrum(kernel,size):
+    """
+    return np.fft.rfft(kernel,size). Spectra of read-only kernels (like the
+    ones kernel_gaussian returns) are remembered, up to SPECTRUM_MB of them.
+    """
+    if kernel.flags.writeable:
+        return np.fft.rfft(kernel,size) # it could change, don't remember it
+    spectrumCache.maxBytes=SPECTRUM_MB*1e6
+    key=(id(kernel),size)
+    spectrum=spectrumCache.get(key)
+    if spectrum is None or spectrum.kernel is not kernel:
+        spectrum=KernelSpectrum(kernel,np.fft.rfft(kernel,size))
+        spectrumCache[key]=spectrum
+    return spectrum.values
+
+class KernelSpectrum:
+    """the FFT of a kernel, kept with the kernel it came from (see kernelSpectrum)."""
+    __slots__=('kernel','values','nbytes')
+
+    def __init__(self,kernel,values):
+        self.kernel=kernel # holding it means its id() can't be reused
+        self.values=values
+        self.nbytes=values.nbytes # for LRU
+
+def lowpass(data,filterSize=None,smoother=None):
     """
     minimal complexity low-pass filtering.
     Filter size is how "wide" the filter will be.
     Sigma will be 1/10 of this filter width.
     If filter size isn't given, it will be 1/10 of the data size.
+    smoother is "kernel" or "boxes" (defaults to SMOOTHER, see smooth()).
     """
     if filterSize is None:
         filterSize=len(data)/10
-    kernel=kernel_gaussian(size=filterSize)
-    data=convolve(data,kernel) # do the convolution with padded edges
+    return smooth(data,filterSize/10,filterSize,smoother)
+
+def smooth(data,sigma,size=None,smoother=None,forwardOnly=False):
+    """
+    gaussian smoothing (along the last axis) with edges padded like convolve.
+    sigma is in points. smoother (defaults to SMOOTHER) is "kernel" to
+    convolve with kernel_gaussian(size,sigma), or "boxes" to approximate it
+    with smoothBoxes(), whose speed doesn't depend on sigma. Only kernels
+    can be forwardOnly.
+    """
+    smoother=smoother or SMOOTHER
+    if smoother=="boxes" and not forwardOnly:
+        return smoothBoxes(data,sigma)
+    if smoother!="kernel" and smoother!="boxes":
+        raise ValueError("unknown smoother [%s]"%smoother)
+    size=sigma*10 if size is None else size
+    return convolve(data,kernel_gaussian(size,sigma,forwardOnly))
+
+def boxWidths(sigma,passes=3):
+    """
+    return the widths (odd numbers of points) of boxes which, applied one
+    after another, blur like a gaussian with this sigma (in points).
+    """
+    ideal=np.sqrt(12*sigma**2/passes+1)
+    small=int(ideal)-(1-int(ideal)%2) # the odd width just below ideal
+    small=max(1,small)
+    big=small+2
+    count=(12*sigma**2-passes*small**2-4*passes*small-3*passes)/(-4*small-4)
+    count=int(min(passes,max(0,round(count)))) # how many use the small width
+    return [small]*count+[big]*(passes-count)
+
+def smoothBoxes(data,sigma,passes=3):
+    """
+    approximate a gaussian blur (sigma in points) along the last axis with
+    a few passes of a moving average. Each pass is a running sum (cumsum),
+    so it takes the same time whatever sigma is. Edges are padded with
+    their values (like convolve) so they don't droop.
+    """
+    data=np.asarray(data,dtype=float)
+    if sigma<=0:
+        return data.copy()
+    for width in boxWidths(sigma,passes):
+        if width<2:
+            continue
+        pad=width//2
+        padWidth=[(0,0)]*(data.ndim-1)+[(pad+1,pad)]
+        padded=np.pad(data,padWidth,mode='edge')
+        offset=padded[...,:1] # keeps running sums small (more precise)
+        sums=np.cumsum(padded-offset,axis=-1)
+        data=(sums[...,width:]-sums[...,:-width])/width+offset
     return data
 
-def convolve(signal,kernel):
+def convolve(signal,kernel,method=None):
     """
     This applies a kernel to a signal through convolution and returns the result.
 
@@ -55,12 +149,171 @@ def convolve(signal,kernel):
         2. perform the convolution ('same' mode)
         3. slice-off the ends we added
         4. return the same number of points as the original
+
+    A 2D signal (sweeps x points) has each row convolved, all in one go.
+    method is "direct" (np.convolve), "fft" (one big FFT), or "overlap-add"
+    (FFTs of blocks about the size of the kernel). If it isn't given, the
+    one expected to be fastest for these sizes is used (see convolveMethod).
+    """
+    signal=np.asarray(signal)
+    kernel=np.asarray(kernel,dtype=float)
+    pad=int(len(kernel)/2)
+    padWidth=[(0,0)]*(signal.ndim-1)+[(pad,pad)]
+    padded=np.pad(signal.astype(float,copy=False),padWidth,mode='edge')
+    first=(len(kernel)-1)//2+pad # where np.convolve 'same' (then unpadding) starts
+    points=signal.shape[-1]
+    method=method or convolveMethod(padded.shape[-1],len(kernel))
+    if method=="direct":
+        rows=padded.reshape(-1,padded.shape[-1])
+        result=np.array([np.convolve(x,kernel)[first:first+points] for x in rows])
+    elif method=="fft":
+        size=fftSize(padded.shape[-1]+len(kernel)-1)
+        result=np.fft.irfft(np.fft.rfft(padded,size)*kernelSpectrum(kernel,size),size)
+        result=result[...,first:first+points]
+    elif method=="overlap-add":
+        result=_overlapAdd(padded,kernel)[...,first:first+points]
+    else:
+        raise ValueError("unknown convolution method [%s]"%method)
+    return result.reshape(signal.shape)
+
+FFT_COST=12 # how many direct multiply-adds one point of an FFT costs (see convolveMethod)
+
+def convolveMethod(signalSize,kernelSize):
+    """
+    guess the fastest way (see convolve) to convolve a signal with a kernel.
+    The costs are rough operation counts (an FFT of N points is ~N*log2(N)).
+    """
+    direct=signalSize*kernelSize
+    size=fftSize(signalSize+kernelSize-1)
+    fft=3*size*np.log2(size)*FFT_COST
+    block=fftSize(4*kernelSize)
+    blocks=np.ceil(signalSize/(block-kernelSize+1))
+    overlapAdd=(blocks+1)*block*np.log2(block)*FFT_COST
+    costs={"direct":direct,"fft":fft,"overlap-add":overlapAdd}
+    return min(costs,key=costs.get)
+
+def fftSize(size):
+    """return the smallest number at least this big with no prime factors above 5."""
+    best=2**int(np.ceil(np.log2(max(1,size))))
+    power5=1
+    while power5<best:
+        power35=power5
+        while power35<best:
+            power235=power35*2**max(0,int(np.ceil(np.log2(size/power35))))
+            best=min(best,power235)
+            power35*=3
+        power5*=5
+    return best
+
+def _overlapAdd(signal,kernel):
+    """full convolution of signal (along its last axis) with kernel by overlap-add."""
+    size=fftSize(4*len(kernel))
+    step=size-len(kernel)+1 # new points per block
+    points=signal.shape[-1]
+    blocks=-(-points//step)
+    padWidth=[(0,0)]*(signal.ndim-1)+[(0,blocks*step-points)]
+    chunks=np.pad(signal,padWidth).reshape(signal.shape[:-1]+(blocks,step))
+    pieces=np.fft.irfft(np.fft.rfft(chunks,size)*kernelSpectrum(kernel,size),size)
+    full=np.zeros(signal.shape[:-1]+((blocks+1)*step+size,))
+    for i in range(0,size,step): # add each part of every block where it goes
+        part=pieces[...,i:i+step]
+        width=part.shape[-1]
+        shifted=np.zeros(part.shape[:-1]+(step,))
+        shifted[...,:width]=part
+        full[...,i:i+blocks*step]+=shifted.reshape(signal.shape[:-1]+(-1,))
+    return full[...,:points+len(kernel)-1]
+
+def minMaxBlocks(data,blockSize,maxs=None):
+    """
+    return the (mins, maxs) of every blockSize points of data, keeping a
+    partial block at the end. If maxs is given, data is a list of minimums
+    and maxs a list of maximums (to combine blocks which were already made).
+    """
+    mins=np.asarray(data)
+    maxs=mins if maxs is None else np.asarray(maxs)
+    full=len(mins)//blockSize*blockSize
+    newMins=mins[:full].reshape(-1,blockSize).min(axis=1)
+    newMaxs=maxs[:full].reshape(-1,blockSize).max(axis=1)
+    if full<len(mins):
+        newMins=np.append(newMins,mins[full:].min())
+        newMaxs=np.append(newMaxs,maxs[full:].max())
+    return newMins,newMaxs
+
+def minMaxPyramid(mins,maxs,blockSize,factor=4,minBlocks=100):
+    """
+    Given the mins and maxs of blocks of blockSize points, return a list of
+    (blockSize, mins, maxs) levels describing the data at lower and lower
+    resolution. Each level combines factor blocks of the level before it,
+    until there are fewer than minBlocks blocks.
     """
-    pad=np.ones(len(kernel)/2)
-    signal=np.concatenate((pad*signal[0],signal,pad*signal[-1]))
-    signal=np.convolve(signal,kernel,mode='same')
-    signal=signal[len(pad):-len(pad)]
-    return signal
+    levels=[(blockSize,mins,maxs)]
+    while len(mins)>=minBlocks*factor:
+        mins,maxs=minMaxBlocks(mins,factor,maxs)
+        blockSize*=factor
+        levels.append((blockSize,mins,maxs))
+    return levels
+
+### caching
+
+class LRU:
+    def __init__(self,maxItems=16,maxBytes=None):
+        """
+        A dict-like cache which forgets the least recently used items.
+        Items are evicted when there are more than maxItems of them, or
+        (if maxBytes is given) when the sum of their .nbytes exceeds maxBytes.
+        Access is guarded by a lock so it can be shared between threads.
+        """
+        self.maxItems=maxItems
+        self.maxBytes=maxBytes
+        self.nbytes=0
+        self.items=collections.OrderedDict()
+        self.lock=threading.RLock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self,key):
+        return key in self.items
+
+    def get(self,key,default=None):
+        """return an item (marking it as recently used) or the default."""
+        with self.lock:
+            if not key in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def __getitem__(self,key):
+        with self.lock:
+            self.items.move_to_end(key) # raises KeyError if missing
+            return self.items[key]
+
+    def __setitem__(self,key,value):
+        with self.lock:
+            self.pop(key)
+            self.items[key]=value
+            self.nbytes+=getattr(value,'nbytes',0)
+            while len(self.items)>1 and (
+                    (self.maxItems and len(self.items)>self.maxItems) or
+                    (self.maxBytes and self.nbytes>self.maxBytes)):
+                self.pop(next(iter(self.items)))
+
+    def pop(self,key,default=None):
+        """remove an item and return it (or the default)."""
+        with self.lock:
+            if not key in self.items:
+                return default
+            value=self.items.pop(key)
+            self.nbytes-=getattr(value,'nbytes',0)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes=0
+
+kernelCache=LRU(KERNEL_CACHE) # see kernel_gaussian
+spectrumCache=LRU(None,SPECTRUM_MB*1e6) # see kernelSpectrum
 
 ### system operations
 
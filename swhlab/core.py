@@ -1,6 +1,6 @@
 """
 This module contains the core SWHLab class which provides ABF file access.
-NeoIO provides ABF file access, the ABF class here simplifies it.
+swhlab.reader (or NeoIO) provides ABF file access, the ABF class simplifies it.
 Plotting is strictly kept out of this module.
 Analysis (event detection, etc) is also kept out of this module.
 """
@@ -16,11 +16,47 @@ import swhlab
 # now import things regularly
 import logging
 #import webinspect
-from neo import io
 import glob
 import pprint
 import webbrowser
+import weakref
+import copy
+import threading
+import queue
 import numpy as np
+import swhlab.reader
+import swhlab.common
+import swhlab.cache
+
+# which library reads ABF files: "native" (swhlab.reader) or "neo" (NeoIO).
+# If the native reader can't handle a file, neo is used automatically.
+BACKEND="native"
+
+# in lazy mode, this many decoded sweeps are kept in memory per ABF
+LAZY_SWEEPS=16
+
+# cachedABF() keeps this many recently opened ABFs in memory
+ABF_CACHE=8
+
+# derived signals (derivatives, filtered sweeps, etc.) kept per ABF (MB)
+DERIVED_MB=200
+
+# the finest level of an envelope pyramid has the min/max of this many points
+PYRAMID_BLOCK=16
+
+# setsweeps() decodes this many upcoming sweeps in a background thread
+PREFETCH_SWEEPS=2
+
+# sweepStats() works on this many points (of every sweep) at a time
+STATS_POINTS=8192
+
+# if True, decoded sweeps are saved in ./swhlab/ and memory-mapped from there
+# the next time the ABF is opened (see swhlab.cache)
+DISK_CACHE=False
+
+# if set to a folder, ABFs are copied there and read from the copy (a local
+# read-through cache for ABFs on network drives, see swhlab.cache.localCopy)
+LOCAL_CACHE=None
 
 def abfIDfromFname(fname):
     """given a filename, return the ABFs ID string."""
@@ -30,6 +66,10 @@ def abfIDfromFname(fname):
 
 def abfProtocol(fname):
     """Determine the protocol used to record an ABF file"""
+    try:
+        return swhlab.reader.ABFHeader(fname).protocol
+    except Exception:
+        pass # not a header we understand, so look for the protocol path
     f=open(fname,'rb')
     raw=f.read(30*1000) #it should be in the first 30k of the file
     f.close()
@@ -53,26 +93,299 @@ def headerHTML(header,fname):
         f.close()
         webbrowser.open(fname)
 
+def unitLabels(units):
+    """
+    given the units of a channel ("mV" or "pA"), return the strings used to
+    label it: (units, units2, unitsD, unitsD2, protoUnits, protoUnits2).
+    """
+    if units == 'pA':
+        return ("pA","clamp current (pA)","pA/ms","current velocity (pA/ms)",
+                "mV","command voltage (mV)")
+    elif units == 'mV':
+        return ("mV","membrane potential (mV)","V/s","potential velocity (V/s)",
+                "pA","command current (pA)")
+    return ("?","unknown units","?","unknown units",None,None)
+
+### derived signals
+# Each transform takes a 2D array (sweeps x points) and the ABF it came from
+# and returns a new 2D array, working along axis 1 so every sweep can be
+# done at once. Add to TRANSFORMS to make more available to ABF.derived().
+
+def transform_derivative(matrix,abf):
+    """first derivative (mV/ms or pA/ms) with its first point duplicated."""
+    D=np.empty(matrix.shape,dtype=np.result_type(matrix,np.float32))
+    D[:,1:]=matrix[:,1:]-matrix[:,:-1]
+    D[:,0]=D[:,1] if matrix.shape[1]>1 else 0 # add a point
+    D*=abf.rate/1000.0 # correct for sample rate
+    return D
+
+def transform_filtered(matrix,abf,sizeMS=10,sigmaMS=None,smoother=None):
+    """gaussian low-pass filter (see ABF.kernel_gaussian and common.smooth)."""
+    sigmaMS=sizeMS/10 if sigmaMS is None else sigmaMS
+    ppms=abf.rate/1000.0
+    return swhlab.common.smooth(matrix,sigmaMS*ppms,sizeMS*ppms,smoother) # every sweep at once
+
+def transform_baseline(matrix,abf,t1=0,t2=None):
+    """subtract the average between t1 and t2 (sec) from each sweep."""
+    I1=int(t1*abf.rate)
+    I2=None if t2 is None else int(t2*abf.rate)
+    return matrix-np.mean(matrix[:,I1:I2],axis=1,keepdims=True)
+
+TRANSFORMS={"derivative":transform_derivative,
+            "filtered":transform_filtered,
+            "baseline":transform_baseline}
+
+# Measurements for ABF.measure(). Each takes a 2D array (sweeps x points,
+# real units) of one time range and returns one value per sweep.
+
+def measure_area(matrix,abf):
+    """area under the curve (units * sec)."""
+    return np.sum(matrix,axis=1)/abf.rate
+
+def measure_peak(matrix,abf):
+    """the value furthest from zero (keeps its sign)."""
+    I=np.argmax(np.abs(matrix),axis=1)
+    return matrix[np.arange(len(matrix)),I]
+
+def measure_slope(matrix,abf):
+    """slope of a least squares line (units / sec)."""
+    X=np.arange(matrix.shape[1])/abf.rate
+    X=X-np.mean(X)
+    Y=matrix-np.mean(matrix,axis=1,keepdims=True)
+    return Y@X/np.sum(X**2)
+
+MEASUREMENTS={"mean":lambda matrix,abf: np.mean(matrix,axis=1),
+              "std":lambda matrix,abf: np.std(matrix,axis=1),
+              "min":lambda matrix,abf: np.min(matrix,axis=1),
+              "max":lambda matrix,abf: np.max(matrix,axis=1),
+              "area":measure_area,
+              "peak":measure_peak,
+              "slope":measure_slope}
+
+class Sweep:
+    """
+    Lightweight read-only view of one sweep of one channel of an ABF.
+    Get these from ABF.getSweep(). Making one never changes the ABF, so many
+    threads can work with different sweeps of the same ABF at the same time.
+    Time and derivative arrays are calculated the first time they are used.
+    """
+    __slots__=('abf','sweep','channel','Y','units','rate','start','_cache')
+
+    def __init__(self,abf,sweep,channel,data):
+        data=data.view()
+        data.flags.writeable=False # a shared view, don't let anyone edit it
+        setattr=object.__setattr__ # this class is otherwise immutable
+        setattr(self,'abf',abf)
+        setattr(self,'sweep',sweep) # sweep number
+        setattr(self,'channel',channel) # channel number
+        setattr(self,'Y',data) # sweep data (mV or pA)
+        setattr(self,'units',abf.channelUnits[channel])
+        setattr(self,'rate',abf.rate) # Hz
+        setattr(self,'start',float(abf.sweepStarts[sweep])) # sweep start (sec)
+        setattr(self,'_cache',{})
+
+    def __setattr__(self,name,value):
+        raise AttributeError("Sweep objects are read-only")
+
+    def __repr__(self):
+        return "<Sweep %d (Ch%d) of %s>"%(self.sweep,self.channel,self.abf.ID)
+
+    def __len__(self):
+        return len(self.Y)
+
+    @property
+    def period(self):
+        return 1.0/self.rate # seconds (inverse of sample rate)
+
+    @property
+    def pointsPerSec(self):
+        return int(self.rate)
+
+    @property
+    def pointsPerMs(self):
+        return int(self.rate/1000.0)
+
+    @property
+    def length(self):
+        return len(self.Y)*self.period # sweep length (seconds)
+
+    def _cached(self,name,function):
+        """return a derived array, calculating it only the first time."""
+        if not name in self._cache:
+            value=function()
+            value.flags.writeable=False
+            self._cache[name]=value
+        return self._cache[name]
+
+    @property
+    def X2(self):
+        """time within the sweep (sec), so sweeps overlap. Shared by sweeps."""
+        return self.abf.timeBase(len(self.Y))
+
+    @property
+    def T(self):
+        """actual time of each point (sec) from the start of the recording."""
+        return self._cached('T',lambda: self.X2+self.start)
+
+    @property
+    def X(self):
+        """time of each point (sec) assuming sweeps have no gaps between them."""
+        return self._cached('X',lambda: self.X2+self.sweep*self.length)
+
+    @property
+    def D(self):
+        """first derivative of the sweep (mV/ms or pA/ms)."""
+        return self.abf.derived("derivative",self.sweep,self.channel)
+
+    def average(self,t1=0,t2=None):
+        """return the average of the sweep between two times (sec)."""
+        I1=max(0,int(t1*self.pointsPerSec))
+        I2=len(self.Y) if t2 is None else max(0,int(t2*self.pointsPerSec))
+        if I2<=I1:
+            return np.nan
+        return np.average(self.Y[I1:I2])
+
+class Chunk:
+    """
+    A window of a recording from ABF.iterChunks(). Y holds the chunk's own
+    points plus margin points on each side (pre and post) which overlap its
+    neighbors. Process all of Y (filter it, take its derivative, etc.), then
+    trim() the result so edge effects fall in the margins and are discarded:
+
+        for chunk in abf.iterChunks(10,overlap=1):
+            smooth=chunk.trim(swhlab.common.convolve(chunk.Y,kernel))
+    """
+    __slots__=('Y','I','pre','post','rate','channel')
+
+    def __init__(self,Y,I,pre,post,rate,channel=0):
+        self.Y=Y # data including margins
+        self.I=I # index (in the whole recording) of the first non-margin point
+        self.pre=pre # number of margin points before the chunk
+        self.post=post # number of margin points after the chunk
+        self.rate=rate # Hz
+        self.channel=channel
+
+    def __repr__(self):
+        return "<Chunk %.03f-%.03f sec (Ch%d)>"%(self.start,self.end,self.channel)
+
+    def __len__(self):
+        return len(self.Y)-self.pre-self.post
+
+    @property
+    def start(self):
+        return self.I/self.rate # time (sec) of the first non-margin point
+
+    @property
+    def end(self):
+        return (self.I+len(self))/self.rate # time (sec) the chunk ends
+
+    @property
+    def T(self):
+        """time (sec) of each non-margin point."""
+        return (np.arange(len(self))+self.I)/self.rate
+
+    def trim(self,data=None):
+        """return data (the same length as Y) without its margins."""
+        data=self.Y if data is None else data
+        return data[self.pre:len(data)-self.post]
+
+    def recordingIndex(self,Is):
+        """
+        convert indexes of Y (events found by a detector) to indexes of the
+        whole recording. Indexes in the margins are dropped, since they belong
+        to the neighboring chunks (which will find them too).
+        """
+        Is=np.asarray(Is,dtype=int)
+        Is=Is[(Is>=self.pre)&(Is<len(self.Y)-self.post)]
+        return Is-self.pre+self.I
+
+class TagIndex:
+    """
+    Sorted index of the comments (tags) of an ABF, made by comments_load()
+    and kept as abf.tags. times (sec), sweeps (the sweep each tag happened in)
+    and text are in chronological order. A tag belongs to the last sweep
+    which started at or before it (sweeps can have gaps between them, see
+    abf.sweepStarts). Lookups use binary searches, so
+    asking questions about tags doesn't mean scanning lists:
+
+        abf.tags.between(60,120) # tag numbers in the second minute
+        abf.tags.epochSweeps(0) # sweeps from the first tag until the next
+        abf.tags.sweepWindow(0,10) # 10 sweeps before and after the first tag
+    """
+    __slots__=('times','sweeps','text','sweepCount')
+
+    def __init__(self,times,text,sweepStarts):
+        times=np.array(times,dtype=float).reshape(-1)
+        order=np.argsort(times,kind='stable')
+        sweepStarts=np.array(sweepStarts,dtype=float).reshape(-1)
+        self.times=times[order] # time of each tag (sec)
+        self.sweepCount=len(sweepStarts) # sweeps in the ABF
+        sweeps=np.searchsorted(sweepStarts,self.times,side='right')-1 # sweeps can have gaps
+        self.sweeps=np.clip(sweeps,0,max(0,self.sweepCount-1)) # sweep of each tag
+        self.text=[str(text[i]) for i in order] # comment of each tag
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return "<TagIndex with %d tags>"%len(self)
+
+    def between(self,t1=0,t2=None):
+        """return the numbers of the tags between t1 and t2 (sec)."""
+        I1=np.searchsorted(self.times,t1,side='left')
+        I2=len(self) if t2 is None else np.searchsorted(self.times,t2,side='right')
+        return np.arange(I1,max(I1,I2))
+
+    def epochOfSweep(self,sweep):
+        """return the number of the last tag at or before a sweep (-1 if none)."""
+        return int(np.searchsorted(self.sweeps,sweep,side='right'))-1
+
+    def epochSweeps(self,tag):
+        """
+        return the sweeps belonging to a tag's epoch: from the sweep the tag
+        is in up to (not including) the sweep of the next tag.
+        """
+        first=self.sweeps[tag]
+        last=self.sweeps[tag+1] if tag+1<len(self) else self.sweepCount
+        return np.arange(first,max(first,last))
+
+    def sweepWindow(self,tag,sweeps=10):
+        """return the sweeps within +/- a number of sweeps of a tag."""
+        center=self.sweeps[tag]
+        return np.arange(max(0,center-sweeps),min(self.sweepCount,center+sweeps+1))
+
 class ABF:
 
-    def __init__(self, fname, createFolder=False):
+    def __init__(self, fname, createFolder=False, backend=None, lazy=False,
+                 cache=None, dtype=None, copyTo=None):
         """
         Load an ABF and makes its stats and sweeps easily available.
 
         Arguments:
             fname - filename of an ABF object
             createFolder - if True, the ./swhlab/ folder will be created
+            backend - "native" or "neo" (defaults to core.BACKEND)
+            lazy - if True, only the header is read when the ABF is opened.
+                   Sweeps are decoded when setsweep() first needs them and
+                   the most recent LAZY_SWEEPS of them are kept in memory.
+            cache - if True, decoded data is cached in the ./swhlab/ folder
+                    (defaults to core.DISK_CACHE).
+            dtype - "float64" (default) or "float32" for sweep data. "int16"
+                    keeps raw samples in memory and scales them only when
+                    they're used (sweeps come out as float32). See toUnits().
+            copyTo - a local folder the ABF is copied to (unless an up to
+                     date copy exists) and read from (defaults to
+                     core.LOCAL_CACHE). Output still goes to ./swhlab/ next
+                     to the original ABF.
         """
         logging.basicConfig(format=swhlab.logFormat, datefmt=swhlab.logDateFormat, level=swhlab.loglevel)
         self.log = logging.getLogger("swhlab ABF")
         self.log.setLevel(swhlab.loglevel)
         if "ABF object" in str(fname):
             self.log.debug("reusing same ABF object")
-            for item in sorted(dir(fname)):
-                try:
-                    setattr(self,item,getattr(fname,item))
-                except:
-                    pass
+            self.__dict__.update(fname.__dict__) # shares data, not state
+            self.master=getattr(fname,'master',None) or fname # keeps the ABF we share data with alive
+            self.cloneState()
             return
         self.log.debug("_"*60)
         self.log.info("SWHLab (%s) loading ABF [%s]",swhlab.__version__,str(fname))
@@ -80,18 +393,41 @@ class ABF:
             self.log.error("path doesn't exist!")
             return
 
+        # read slow (network) ABFs from a local copy
+        localFolder=copyTo or LOCAL_CACHE
+        self.localFilename=os.path.abspath(fname) # the file actually read
+        if localFolder:
+            self.localFilename=swhlab.cache.localCopy(fname,localFolder)
+
         # load the ABF and populate properties
-        self.ABFreader = io.AxonIO(filename=fname)
-        self.ABFblock = self.ABFreader.read_block(lazy=False, cascade=True)
-        self.header=self.ABFreader.read_header()
-        self.protocomment=abfProtocol(fname) # get ABF file comment
+        self.backend=None
+        self.lazy=lazy
+        self.dtype=np.dtype(dtype or 'float64') # dtype of decoded sweeps
+        self.raw=self.dtype.kind in 'iu' # keep unscaled samples in memory
+        if self.raw:
+            self.dtype=np.dtype('float32')
+        self.sweepCache=swhlab.common.LRU(LAZY_SWEEPS) # decoded sweeps (lazy mode)
+        self.derivedCache=swhlab.common.LRU(None,DERIVED_MB*1e6) # see derived()
+        if (backend or BACKEND)=="native":
+            try:
+                self.load_native(self.localFilename)
+            except Exception as e:
+                self.log.warning("native reader failed (%s), trying neo",e)
+        if self.backend is None:
+            self.load_neo(self.localFilename)
         self.ID=abfIDfromFname(fname) # filename without extension
         self.filename=os.path.abspath(fname) # full path to file on disk
         self.fileID=os.path.abspath(os.path.splitext(self.filename)[0]) # no extension
         self.outFolder=os.path.abspath(os.path.dirname(fname)+"/swhlab/") # save stuff here
         self.outPre=os.path.join(self.outFolder,self.ID)+'_' # save files prefixed this
-        self.sweeps=self.ABFblock.size["segments"] # number of sweeps in ABF
-        self.timestamp=self.ABFblock.rec_datetime # when the ABF recording started
+        self.diskCache=None # decoded data (channels x sweeps x points)
+        self.useDiskCache=DISK_CACHE if cache is None else cache
+        if self.useDiskCache:
+            self.cache_load()
+        self.pyramids={} # min/max envelope pyramid of each channel
+        self.prefetched={} # sweeps decoded ahead of time (see prefetchSweeps)
+        self.timeBaseShared=None # times within a sweep (see timeBase)
+        self.master=None # the ABF this one is a clone of (see clone)
 
         # these I still have to read directly out of the header
         self.holding = self.header['listDACInfo'][0]['fDACHoldingLevel'] #clamp current or voltage
@@ -99,15 +435,410 @@ class ABF:
         # we've pulled what we can out of the header, now proceed with advanced stuff
         self.derivative=False # whether or not to use the first derivative
         self.setsweep() # run setsweep to populate sweep properties
+        self.compileProtocol() # epoch table (for protoX, commandMatrix, etc.)
         self.comments_load() # populate comments
         self.kernel=None # variable which may be set for convolution
+        self.kernelInfo=None # (kernel, sigma, forwardOnly) from kernel_gaussian
         if createFolder:
             self.output_touch() # make sure output folder exists
-        #TODO: detect if invalid or corrupted ABF
         self.log.debug("ABF loaded. (protocol: %s)"%self.protocomment)
 
-    def setsweep(self, sweep=0, channel=0):
-        """set the sweep and channel of an ABF. Both start at 0."""
+    def load_native(self,fname):
+        """open the ABF with the built-in memory-mapped reader."""
+        self.ABFreader = swhlab.reader.ABFreader(fname)
+        self.ABFblock = None
+        self.trace = None
+        self.header = self.ABFreader.header
+        self.protocomment = self.ABFreader.protocol # protocol number
+        self.sweeps = self.ABFreader.sweeps # number of sweeps in ABF
+        self.timestamp = self.ABFreader.timestamp # when the ABF recording started
+        self.channels = self.ABFreader.channels # number of ADC channels
+        self.channelUnits = self.ABFreader.adcUnits # units of each channel
+        self.rate = self.ABFreader.rate # Hz
+        self.sweepStarts = self.ABFreader.sweepStarts # start time of each sweep (sec)
+        self.scale,self.offset = self.ABFreader.scale,self.ABFreader.offset # raw to units
+        self.backend = "native"
+
+    def load_neo(self,fname):
+        """
+        open the ABF with NeoIO. With a neo new enough to have the rawio API
+        only the header is read here and sweeps are pulled out one at a time
+        (and kept in memory only in lazy mode). Older neo decodes every sweep
+        into memory.
+        """
+        from neo import io
+        self.ABFreader = io.AxonIO(filename=fname)
+        self.ABFblock = None
+        self.trace = None
+        self.protocomment=abfProtocol(fname) # get ABF file comment
+        if hasattr(self.ABFreader,'get_analogsignal_chunk'):
+            from neo.rawio.axonrawio import parse_axon_soup
+            if not self.ABFreader.header:
+                self.ABFreader.parse_header()
+            self.header = parse_axon_soup(fname)
+            self.sweeps = self.ABFreader.segment_count(0)
+            self.timestamp = self.header['rec_datetime']
+            channels = self.ABFreader.header['signal_channels']
+            self.channels = len(channels)
+            self.channelUnits = [str(x) for x in channels['units']]
+            self.rate = int(channels['sampling_rate'][0])
+            self.sweepStarts = np.array([self.ABFreader.segment_t_start(0,x)
+                                         for x in range(self.sweeps)])
+            self.scale = np.array(channels['gain'],dtype=float) # raw to units
+            self.offset = np.array(channels['offset'],dtype=float)
+            self.backend = "neo"
+            return
+        if self.lazy:
+            self.log.warning("this version of neo can't read sweeps lazily")
+        if self.raw:
+            self.log.warning("this version of neo can't keep raw samples")
+            self.raw=False
+        self.ABFblock = self.ABFreader.read_block(lazy=False)
+        self.header=self.ABFreader.read_header()
+        self.sweeps=self.ABFblock.size["segments"] # number of sweeps in ABF
+        self.timestamp=self.ABFblock.rec_datetime # when the ABF recording started
+        signals=self.ABFblock.segments[0].analogsignals
+        self.channels=len(signals)
+        self.channelUnits=[str(x.dimensionality) for x in signals]
+        self.rate=int(signals[0].sampling_rate)
+        self.sweepStarts=np.array([float(x.analogsignals[0].t_start)
+                                   for x in self.ABFblock.segments])
+        self.scale,self.offset=np.ones(self.channels),np.zeros(self.channels)
+        self.backend = "neo"
+
+    def cache_load(self):
+        """
+        memory-map decoded data from the disk cache, decoding the ABF and
+        caching it first if needed. Floating point ABFs opened with the
+        native reader are already memory-mapped, so they aren't cached.
+        """
+        if self.backend=="native" and (self.raw or self.ABFreader.dtype.kind=='f'):
+            self.log.debug("ABF data is already memory-mapped, not caching it")
+            return
+        try:
+            data=swhlab.cache.load(self)
+            if data is None:
+                self.log.debug("caching decoded sweeps")
+                data=swhlab.cache.save(self,self.sweepStack(scaled=False))
+            self.diskCache=data
+        except Exception as e:
+            self.log.warning("disk cache failed (%s)",e)
+
+    def sweepData(self,sweep=0,channel=0):
+        """
+        return the data (mV or pA) of a sweep without changing the current
+        sweep. In lazy mode decoded sweeps are remembered in self.sweepCache.
+        """
+        return self.toUnits(self.sweepStored(sweep,channel),channel)
+
+    def sweepStored(self,sweep=0,channel=0):
+        """
+        return the data of a sweep the way this ABF keeps it in memory:
+        raw samples for raw ABFs, otherwise the same as sweepData().
+        """
+        if self.diskCache is not None:
+            return self.diskCache[channel,sweep]
+        data=self.prefetched.pop((sweep,channel),None)
+        if data is not None:
+            if self.lazy:
+                data.flags.writeable=False # shared with clones (see cloneState)
+                self.sweepCache[(sweep,channel)]=data
+            return data
+        if not self.lazy:
+            return self.decodeSweep(sweep,channel)
+        data=self.sweepCache.get((sweep,channel))
+        if data is None:
+            self.log.debug("decoding sweep %d (Ch%d)",sweep,channel)
+            data=self.decodeSweep(sweep,channel)
+            data.flags.writeable=False # shared with clones (see cloneState)
+            self.sweepCache[(sweep,channel)]=data
+        return data
+
+    def decodeSweep(self,sweep=0,channel=0,I1=None,I2=None):
+        """
+        read the data of one sweep using whichever backend is loaded.
+        Raw ABFs get unscaled samples (see toUnits()).
+        If I1 and I2 are given, only the points between them are read.
+        """
+        if self.backend=="native":
+            raw=self.ABFreader.raw(sweep,channel)[I1:I2]
+            if self.raw:
+                return raw
+            return self.ABFreader.scaled(raw,channel,self.dtype)
+        if self.ABFblock is not None:
+            data=self.ABFblock.segments[sweep].analogsignals[channel].magnitude
+            return data[I1:I2].astype(self.dtype,copy=False)
+        kwargs={'channel_indexes':[channel]}
+        if 'signal_streams' in self.ABFreader.header:
+            kwargs['stream_index']=0 # newer neo organizes channels in streams
+        raw=self.ABFreader.get_analogsignal_chunk(0,sweep,I1,I2,**kwargs)
+        if self.raw:
+            return raw[:,0]
+        data=self.ABFreader.rescale_signal_raw_to_float(raw,dtype=self.dtype.name,**kwargs)
+        return data[:,0]
+
+    def decodeSweepChannels(self,sweep=0):
+        """
+        read every channel of one sweep in a single pass and return them as
+        a 2D array (channels x points).
+        """
+        if self.backend=="native":
+            return np.array([self.decodeSweep(sweep,x) for x in range(self.channels)])
+        if self.ABFblock is not None:
+            signals=self.ABFblock.segments[sweep].analogsignals
+            return np.array([np.ravel(x.magnitude) for x in signals],dtype=self.dtype)
+        kwargs={'channel_indexes':None}
+        if 'signal_streams' in self.ABFreader.header:
+            kwargs['stream_index']=0 # newer neo organizes channels in streams
+        raw=self.ABFreader.get_analogsignal_chunk(0,sweep,None,None,**kwargs)
+        if self.raw:
+            return raw.T
+        data=self.ABFreader.rescale_signal_raw_to_float(raw,dtype=self.dtype.name,**kwargs)
+        return data.T
+
+    def recordingView(self,channel=0):
+        """
+        return a 1D view of every sweep of a channel joined end to end (the
+        way sweepStored() keeps them), or None if the data isn't stored that
+        way (neo, or integer ABFs scaled on the fly). Nothing is copied.
+        """
+        if self.diskCache is not None:
+            return self.diskCache.reshape(self.channels,-1)[channel]
+        if self.backend=="native" and (self.raw or self.ABFreader.dtype.kind=='f'):
+            return self.ABFreader.data.reshape(-1,self.channels)[:,channel]
+        return None
+
+    def recordingData(self,I1,I2,channel=0,scaled=True):
+        """
+        return the data between two point indexes of the whole recording
+        (sweeps joined end to end, like sweepX). Only that part of the file
+        is read, so this works on gap free recordings of any length.
+        If scaled is False, raw ABFs return raw samples (see toUnits()).
+        Where possible (see recordingView) this is a view, not a copy. Native
+        integer ABFs scale that part of the file into a single new array.
+        """
+        view=self.recordingView(channel)
+        if view is not None:
+            data=view[I1:I2]
+            return self.toUnits(data,channel) if scaled else data
+        if self.backend=="native":
+            raw=self.ABFreader.data.reshape(-1,self.channels)[I1:I2,channel]
+            return self.ABFreader.scaled(raw,channel,self.dtype)
+        size=self.sweepSize
+        pieces=[]
+        for sweep in range(I1//size,min(self.sweeps,(I2-1)//size+1)):
+            J1,J2=max(0,I1-sweep*size),min(size,I2-sweep*size)
+            pieces.append(self.decodeSweep(sweep,channel,J1,J2))
+        data=pieces[0] if len(pieces)==1 else np.concatenate(pieces)
+        return self.toUnits(data,channel) if scaled else data
+
+    def timeIndex(self,times):
+        """
+        convert times (sec from the start of the recording, using the real
+        start time of each sweep) to point indexes of the whole recording
+        (sweeps joined end to end). Each index is the first point at or after
+        its time, so times between sweeps land on the start of the next one.
+        """
+        times=np.asarray(times,dtype=float)
+        sweeps=np.searchsorted(self.sweepStarts,times,side='right')-1
+        sweeps=np.clip(sweeps,0,self.sweeps-1)
+        points=np.ceil((times-self.sweepStarts[sweeps])*self.rate-1e-6)
+        points=np.clip(points,0,self.sweepSize).astype(int)
+        return sweeps*self.sweepSize+points
+
+    def indexTime(self,indexes):
+        """convert point indexes of the whole recording to times (sec)."""
+        sweeps,points=np.divmod(np.asarray(indexes),self.sweepSize)
+        return self.sweepStarts[sweeps]+points/self.rate
+
+    def slice(self,t1=None,t2=None,channel=None):
+        """
+        Return (T, Y): the time (sec) and data of every point recorded
+        between t1 and t2 (sec from the start of the recording), across as
+        many sweeps as that spans. Times come from the real start time of
+        each sweep (so T skips over gaps between sweeps, unlike sweepX).
+        Y is a view of the data when possible (see recordingData).
+
+            T,Y=abf.slice(tag-60,tag+120) # a minute before to 2 after a tag
+        """
+        channel=self.channel if channel is None else channel
+        total=self.sweeps*self.sweepSize
+        I1=0 if t1 is None else int(self.timeIndex(t1))
+        I2=total if t2 is None else int(self.timeIndex(t2))
+        if I2<=I1:
+            empty=np.array([])
+            return empty,empty
+        return self.indexTime(np.arange(I1,I2)),self.recordingData(I1,I2,channel)
+
+    def iterChunks(self,seconds=10,overlap=0,channel=None):
+        """
+        Yield the whole recording (sweeps joined end to end, or the only
+        "sweep" of a gap free ABF) as Chunk objects of a given length (sec).
+        Each chunk carries up to overlap seconds of its neighbors' data on
+        each side so filters and detectors have real data at their edges.
+        Chunks are read from the file one at a time, so memory use depends on
+        the chunk size and not on the length of the recording.
+        """
+        channel=self.channel if channel is None else channel
+        size=max(1,int(seconds*self.pointsPerSec))
+        margin=max(0,int(overlap*self.pointsPerSec))
+        total=self.sweeps*self.sweepSize
+        for I1 in range(0,total,size):
+            I2=min(total,I1+size)
+            J1,J2=max(0,I1-margin),min(total,I2+margin)
+            data=self.recordingData(J1,J2,channel)
+            yield Chunk(data,I1,I1-J1,J2-I2,self.rate,channel)
+
+    def pyramid(self,channel=None):
+        """
+        return the min/max envelope pyramid (a list of (blockSize, mins, maxs)
+        levels, see common.minMaxPyramid) of a whole channel, with sweeps
+        joined end to end. It's made in one pass (a chunk at a time) the first
+        time it's needed, and saved in ./swhlab/ if the disk cache is on.
+        """
+        channel=self.channel if channel is None else channel
+        if channel in self.pyramids:
+            return self.pyramids[channel]
+        name="pyramid%d"%channel
+        arrays=swhlab.cache.loadArrays(self,name) if self.useDiskCache else None
+        if arrays:
+            levels=[(int(size),arrays['mins%d'%i],arrays['maxs%d'%i])
+                    for i,size in enumerate(arrays['sizes'])]
+        else:
+            self.log.debug("building envelope pyramid (Ch%d)",channel)
+            total=self.sweeps*self.sweepSize
+            step=PYRAMID_BLOCK*2**16 # points read at a time
+            mins,maxs=[],[]
+            for I1 in range(0,total,step):
+                data=self.recordingData(I1,min(total,I1+step),channel,scaled=False)
+                blockMins,blockMaxs=swhlab.common.minMaxBlocks(data,PYRAMID_BLOCK)
+                mins.append(blockMins)
+                maxs.append(blockMaxs)
+            mins=self.toUnits(np.concatenate(mins),channel)
+            maxs=self.toUnits(np.concatenate(maxs),channel)
+            if self.raw and self.scale[channel]<0:
+                mins,maxs=maxs,mins # negative scaling flips the envelope
+            levels=swhlab.common.minMaxPyramid(mins,maxs,PYRAMID_BLOCK)
+            if self.useDiskCache:
+                arrays={'sizes':np.array([x[0] for x in levels])}
+                for i,(size,levelMins,levelMaxs) in enumerate(levels):
+                    arrays['mins%d'%i],arrays['maxs%d'%i]=levelMins,levelMaxs
+                try:
+                    swhlab.cache.saveArrays(self,name,arrays)
+                except Exception as e:
+                    self.log.warning("couldn't cache envelope pyramid (%s)",e)
+        self.pyramids[channel]=levels
+        return levels
+
+    def envelope(self,t1=None,t2=None,pixels=1000,channel=None):
+        """
+        Return (T, Ymin, Ymax) describing the recording (sweeps joined end
+        to end, like sweepX) between t1 and t2 (sec) in about pixels points,
+        ready for plt.fill_between(). Each point is the min and max of all the
+        data it covers, so it looks exactly like plotting every point would.
+        If there isn't more data than pixels, the data itself is returned
+        (Ymin and Ymax are the same array). Uses pyramid(), so it's fast.
+        """
+        channel=self.channel if channel is None else channel
+        total=self.sweeps*self.sweepSize
+        I1=0 if t1 is None else max(0,int(round(t1*self.pointsPerSec)))
+        I2=total if t2 is None else min(total,int(round(t2*self.pointsPerSec)))
+        if I2<=I1:
+            empty=np.array([])
+            return empty,empty,empty
+        perPixel=(I2-I1)/max(1,int(pixels))
+        levels=[x for x in self.pyramid(channel) if x[0]<=perPixel]
+        if not levels:
+            Y=self.recordingData(I1,I2,channel)
+            return np.arange(I1,I2)/self.rate,Y,Y
+        size,mins,maxs=levels[-1] # the coarsest level fine enough to use
+        B1,B2=I1//size,-(-I2//size)
+        mins,maxs=mins[B1:B2],maxs[B1:B2]
+        edges=np.unique(np.linspace(0,len(mins),int(pixels)+1).astype(int)[:-1])
+        Ymin=np.minimum.reduceat(mins,edges)
+        Ymax=np.maximum.reduceat(maxs,edges)
+        return (B1+edges)*size/self.rate,Ymin,Ymax
+
+    def toUnits(self,data,channel=None):
+        """
+        convert data the way this ABF keeps it (see sweepStored()) into real
+        units (mV or pA). This only does something for raw ABFs, where it's
+        much cheaper to reduce samples (average them, etc.) before scaling.
+        If channel is None, the first axis of data is the channel.
+        """
+        if not self.raw:
+            return data
+        if channel is None:
+            shape=(-1,)+(1,)*(np.ndim(data)-1)
+            scale,offset=self.scale.reshape(shape),self.offset.reshape(shape)
+        else:
+            scale,offset=self.scale[channel],self.offset[channel]
+        if np.ndim(data)==0:
+            return data*scale+offset
+        data=np.multiply(np.asarray(data),scale,dtype=np.result_type(data,self.dtype))
+        data+=offset
+        return data
+
+    def derived(self,transform,sweep=None,channel=None,**params):
+        """
+        return a derived signal ("derivative", "filtered", "baseline", or
+        anything else in core.TRANSFORMS) of a sweep, or of every sweep
+        (as a 2D array) if sweep is None. Results are remembered per
+        (sweep, channel, transform, params) up to DERIVED_MB, and asking for
+        every sweep computes them all at once. Treat them as read-only.
+
+            abf.derived("derivative",3) # dV/dt of sweep 3
+            abf.derived("filtered",sizeMS=20) # every sweep, low-passed
+        """
+        if not transform in TRANSFORMS:
+            raise ValueError("unknown transform [%s]"%transform)
+        channel=self.channel if channel is None else channel
+        params=tuple(sorted(params.items()))
+        sweeps=range(self.sweeps) if sweep is None else [sweep]
+        keys=[(x,channel,transform,params) for x in sweeps]
+        rows=[self.derivedCache.get(x) for x in keys]
+        missing=[x for x,row in zip(sweeps,rows) if row is None]
+        if missing:
+            if sweep is None:
+                data=self.sweepMatrix(channel)[missing]
+            else:
+                data=self.sweepData(sweep,channel)[np.newaxis]
+            data=TRANSFORMS[transform](data,self,**dict(params))
+            data.flags.writeable=False
+            for row,x in zip(data,missing):
+                self.derivedCache[(x,channel,transform,params)]=row
+                rows[sweeps.index(x)]=row
+            if sweep is None and len(missing)==len(rows):
+                return data # no need to copy rows into a new array
+        if sweep is None:
+            return np.array(rows)
+        return rows[0]
+
+    def getSweep(self, sweep=0, channel=0):
+        """
+        return a read-only Sweep object for a sweep and channel (both start
+        at 0, negative sweeps count from the end). Unlike setsweep(), this
+        doesn't change anything about the ABF, so it is safe to use from
+        helper functions and from multiple threads at once.
+        """
+        sweep=int(sweep)
+        if sweep<0:
+            sweep+=self.sweeps
+        if not 0<=sweep<self.sweeps:
+            raise IndexError("sweep %d doesn't exist"%sweep)
+        if not 0<=channel<self.channels:
+            raise IndexError("channel %d doesn't exist"%channel)
+        return Sweep(self,sweep,channel,self.sweepData(sweep,channel))
+
+    def setsweep(self, sweep=0, channel=None):
+        """
+        set the sweep and channel of an ABF. Both start at 0.
+        If channel isn't given, the currently selected channel is kept.
+        This populates sweepY, sweepX, etc. from getSweep(). sweepY can be
+        edited without changing currentSweep or the ABF's data: a freshly
+        decoded sweep is used as it is, and shared data (cached sweeps,
+        memory-mapped files) is copied.
+        """
         try:
             sweep=int(sweep)
         except:
@@ -116,74 +847,200 @@ class ABF:
         if sweep<0:
             sweep=self.sweeps-1-sweep # if negative, start from the end
         sweep=max(0,min(sweep,self.sweeps-1)) # correct for out of range sweeps
-        if 'sweep' in dir(self) and self.sweep == sweep and self.derivative is False:
+        if channel is None:
+            channel=getattr(self,'channel',0) # stay on the same channel
+        if not 0<=channel<self.channels:
+            self.log.error("channel %d doesn't exist",channel)
+            return
+        if (getattr(self,'sweep',None)==sweep and self.channel==channel
+            and (self.derivative is False or len(self.sweepD)>1)):
             self.log.debug("sweep %d already set",sweep)
             return
         #self.log.debug("loading sweep %d (Ch%d)",sweep,channel)
-        self.channels=self.ABFblock.segments[sweep].size["analogsignals"]
-        if self.channels>1 and sweep==0:
-            self.log.info("WARNING: multichannel not yet supported!") #TODO:
-        self.trace = self.ABFblock.segments[sweep].analogsignals[channel]
+        if self.ABFblock is not None:
+            self.trace = self.ABFblock.segments[sweep].analogsignals[channel]
+        data = self.sweepData(sweep,channel)
+        thisSweep = Sweep(self,sweep,channel,data)
+        if data.flags.owndata and data.flags.writeable:
+            self.sweepY = data # sweep data (mV or pA), decoded just for us
+            self.sweepCurrent = None # made from a new copy if it's asked for
+        else:
+            self.sweepY = np.array(data) # our own copy of shared data
+            self.sweepCurrent = thisSweep
+        self.sweepStart = thisSweep.start # time start of sweep (sec)
         self.sweep=sweep # currently selected sweep
         self.channel=channel # currently selected channel
 
         # sweep information
-        self.rate = int(self.trace.sampling_rate) # Hz
-        self.period = float(1/self.rate) # seconds (inverse of sample rate)
-        self.pointsPerSec = int(self.rate) # for easy access
-        self.pointsPerMs = int(self.rate/1000.0) # for easy access
-        self.sweepSize = len(self.trace) # number of data points per sweep
-        self.sweepInterval = self.trace.duration.magnitude # sweep interval (seconds)
-        self.sweepLength = float(self.trace.t_stop-self.trace.t_start) # in seconds
+        self.period = thisSweep.period # seconds (inverse of sample rate)
+        self.pointsPerSec = thisSweep.pointsPerSec # for easy access
+        self.pointsPerMs = thisSweep.pointsPerMs # for easy access
+        self.sweepSize = len(thisSweep) # number of data points per sweep
+        self.sweepLength = thisSweep.length # in seconds
+        self.sweepInterval = self.sweepLength # sweep interval (seconds)
         self.length = self.sweepLength*self.sweeps # length (sec) of total recording
         self.lengthMinutes = self.length/60.0 # length (minutes) of total recording
+        (self.units,self.units2,self.unitsD,self.unitsD2,
+         protoUnits,protoUnits2) = unitLabels(thisSweep.units)
+        if protoUnits:
+            self.protoUnits,self.protoUnits2 = protoUnits,protoUnits2
 
-        if str(self.trace.dimensionality) == 'pA':
-            self.units,self.units2="pA","clamp current (pA)"
-            self.unitsD,self.unitsD2="pA/ms","current velocity (pA/ms)"
-            self.protoUnits,self.protoUnits2="mV","command voltage (mV)"
-        elif str(self.trace.dimensionality) == 'mV':
-            self.units,self.units2="mV","membrane potential (mV)"
-            self.unitsD,self.unitsD2="V/s","potential velocity (V/s)"
-            self.protoUnits,self.protoUnits2="pA","command current (pA)"
-        else:
-            self.units,self.units2="?","unknown units"
-            self.unitsD,self.unitsD2="?","unknown units"
-
-        # sweep data
-        self.sweepY = self.trace.magnitude # sweep data (mV or pA)
-        self.sweepT = self.trace.times.magnitude # actual sweep times (sec)
-        self.sweepStart = float(self.trace.t_start) # time start of sweep (sec)
-        self.sweepX2 = self.sweepT-self.trace.t_start.magnitude # sweeps overlap
-        self.sweepX = self.sweepX2+sweep*self.sweepInterval # assume no gaps
+        # sweep data (sweepX2, sweepT, and sweepX are made when they're used)
+        self.sweepInfo = thisSweep # for times and derivatives, never its Y
         if self.derivative:
-            self.log.debug("taking derivative")
-            #self.sweepD=np.diff(self.sweepY) # take derivative
-            self.sweepD=self.sweepY[1:]-self.sweepY[:-1] # better?
-            self.sweepD=np.insert(self.sweepD,0,self.sweepD[0]) # add a point
-            self.sweepD/=(self.period*1000) # correct for sample rate
+            self.sweepD = thisSweep.D # remembered in self.derivedCache
         else:
             self.sweepD=[0] # derivative is forced to be empty
 
-        # generate the protocol too
-        self.generate_protocol()
+        # the protocol (protoX, etc.) is generated when it's first used
+
+    @property
+    def currentSweep(self):
+        """the current sweep as a read-only Sweep (see getSweep)."""
+        if self.sweepCurrent is None: # sweepY holds the only decoded copy
+            self.sweepCurrent = self.getSweep(self.sweep,self.channel)
+        return self.sweepCurrent
+
+    @property
+    def sweepX2(self):
+        """time of each point within the sweep (sec), so sweeps overlap."""
+        return self.sweepInfo.X2
+
+    @property
+    def sweepT(self):
+        """actual time of each point of the sweep (sec)."""
+        return self.sweepInfo.T
+
+    @property
+    def sweepX(self):
+        """time of each point of the sweep (sec), assuming no gaps."""
+        return self.sweepInfo.X
+
+    def timeBase(self,points=None):
+        """
+        return a read-only array of the time (sec) of each point within a
+        sweep. It's made once and shared by every sweep (see Sweep.X2).
+        """
+        points=self.sweepSize if points is None else points
+        timeBase=self.timeBaseShared
+        if timeBase is None or len(timeBase)!=points:
+            timeBase=np.arange(points)*(1.0/self.rate)
+            timeBase.flags.writeable=False
+            self.timeBaseShared=timeBase
+        return timeBase
 
     def sweepList(self):
         """return a list of sweep numbers."""
         return range(self.sweeps)
 
-    def setsweeps(self):
-        """iterate over every sweep"""
-        for sweep in range(self.sweeps):
-            self.setsweep(sweep)
-            yield self.sweep
+    def setsweeps(self,prefetch=None):
+        """
+        iterate over every sweep. Upcoming sweeps are decoded in the
+        background while the current one is used (see prefetchSweeps).
+        prefetch is how many sweeps ahead to work (PREFETCH_SWEEPS if not
+        given, 0 to turn it off).
+        """
+        depth=PREFETCH_SWEEPS if prefetch is None else prefetch
+        sweeps=self.prefetchSweeps(depth=depth) if depth else iter(range(self.sweeps))
+        try:
+            for sweep in sweeps:
+                self.setsweep(sweep)
+                yield self.sweep
+        finally:
+            if hasattr(sweeps,'close'):
+                sweeps.close() # stop the background thread now
+
+    def prefetchSweeps(self,sweeps=None,channel=None,depth=2):
+        """
+        Yield sweep numbers (every sweep if not given) once their data has
+        been decoded by a background thread, which works up to depth sweeps
+        ahead so reading the file overlaps with whatever the caller does with
+        each sweep. Decoded data waits in self.prefetched until sweepData()
+        picks it up. When the loop ends, or the generator is closed, the
+        thread is stopped and joined and leftover data is thrown away.
+        """
+        sweeps=list(range(self.sweeps) if sweeps is None else sweeps)
+        channel=self.channel if channel is None else channel
+        if self.diskCache is not None or depth<1:
+            for sweep in sweeps:
+                yield sweep # already in memory (or prefetching is off)
+            return
+        ready=queue.Queue(maxsize=depth) # bounds how far ahead the thread gets
+        stop=threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item,timeout=.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def worker():
+            try:
+                for sweep in sweeps:
+                    if stop.is_set():
+                        return
+                    data=self.decodeSweep(sweep,channel)
+                    if isinstance(data,np.memmap):
+                        data=np.array(data) # actually read it from disk now
+                    self.prefetched[(sweep,channel)]=data
+                    put(sweep)
+            except Exception as e:
+                put(e)
+            put(None)
+
+        thread=threading.Thread(target=worker,name="swhlab prefetch")
+        thread.daemon=True
+        thread.start()
+        try:
+            while True:
+                item=ready.get()
+                if item is None:
+                    return
+                if isinstance(item,Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+            for sweep in sweeps:
+                self.prefetched.pop((sweep,channel),None)
 
     def comments_load(self):
-        """read the header and populate self with information about comments"""
+        """
+        read the header and populate self with information about comments.
+        comment_times, comment_sweeps and comment_tags are parallel lists, and
+        tags is a TagIndex of them for fast lookups.
+        """
+        self.comments_read()
+        self.tags=TagIndex(self.comment_times,self.comment_tags,self.sweepStarts)
+
+    def comments_read(self):
+        """read comments (tags) from whichever backend is loaded."""
         self.comment_times,self.comment_sweeps,self.comment_tags=[],[],[]
         self.comments=0 # will be >0 if comments exist
         self.comment_text=""
 
+        if self.backend=="native":
+            self.comment_tags = list(self.ABFreader.tagComments)
+            self.comment_times = np.array(self.ABFreader.tagTimes)
+            self.comment_sweeps = self.comment_times/self.sweepInterval
+            return
+        if self.ABFblock is None: # neo's rawio API
+            for sweep in range(self.sweeps):
+                if not self.ABFreader.event_channels_count():
+                    break
+                if not self.ABFreader.event_count(0,sweep,0):
+                    continue
+                times,durations,labels=self.ABFreader.get_event_timestamps(0,sweep,0)
+                times=self.ABFreader.rescale_event_timestamp(times,dtype='float64')
+                self.comment_tags.extend([str(x) for x in labels])
+                self.comment_times.extend(list(times))
+            self.comment_times = np.array(self.comment_times)
+            self.comment_sweeps = self.comment_times/self.sweepInterval
+            return
+
         try:
             # this used to work
             self.comment_tags = list(self.ABFblock.segments[0].eventarrays[0].annotations['comments'])
@@ -199,94 +1056,142 @@ class ABF:
         for i,c in enumerate(self.comment_tags):
             self.comment_tags[i]=c.decode("utf-8")
 
-    def generate_protocol(self):
+    def compileProtocol(self):
         """
-        Recreate the command stimulus (protocol) for the current sweep.
-        It's not stored point by point (that's a waste of time and memory!)
-        Instead it's stored as a few (x,y) points which can be easily graphed.
-
-        TODO: THIS
-        for segment in abf.ABFreader.read_protocol():
-            for analogsignal in segment.analogsignals:
-                print(analogsignal)
-                plt.plot(analogsignal)
-                plt.show()
-                plt.close('all')
-
+        Compile the epoch table of every DAC (dictEpochInfoPerDAC) into arrays
+        once, so the command stimulus of any sweep can be looked up or built
+        without walking through the epochs again. Epochs start after a holding
+        period which takes up the first 1/64 of every sweep. Like the rest of
+        this module, epochs are treated as steps (ramps, pulse trains, and
+        duration increments are ignored).
         """
-        # TODO: elegantly read the protocol like this:
-            #abf.ABFreader.read_protocol()[0].analogsignals()[sigNum]
-
-
-
-        # TODO: right now this works only for the first channel
-
         # correct for weird recording/protocol misalignment
         #what is magic here? 64-bit data points? #1,000,000/64 = 15625 btw
         self.offsetX = int(self.sweepSize/64)
+        self.protocolTables={}
+        DACs=self.header['listDACInfo']
+        for DAC,epochs in self.header['dictEpochInfoPerDAC'].items():
+            epochs=[epochs[x] for x in sorted(epochs)]
+            DACinfo=DACs[DAC] if DAC<len(DACs) else DACs[0]
+            table={}
+            table['duration']=np.array([x['lEpochInitDuration'] for x in epochs],dtype=int)
+            table['end']=self.offsetX+np.cumsum(table['duration']) # points
+            table['start']=table['end']-table['duration'] # points
+            table['level']=np.array([x['fEpochInitLevel'] for x in epochs],dtype=float)
+            table['inc']=np.array([x['fEpochLevelInc'] for x in epochs],dtype=float)
+            table['holding']=DACinfo['fDACHoldingLevel']
+            table['holdLast']=bool(DACinfo['nInterEpisodeLevel']) # end on last level
+            self.protocolTables[DAC]=table
+
+    def protocolTable(self,channel=None):
+        """
+        return the compiled epoch table (see compileProtocol) of the DAC
+        which matches a channel (the current one if not given), or None.
+        """
+        if not self.protocolTables:
+            return None
+        channel=self.channel if channel is None else channel
+        if channel in self.protocolTables:
+            return self.protocolTables[channel]
+        return self.protocolTables[min(self.protocolTables)]
+
+    def commandLevels(self,channel=None):
+        """
+        return a 2D array (sweeps x segments) of the command value of each
+        segment of each sweep. Segments are: the holding period before the
+        first epoch, each epoch, and the period after the last epoch.
+        Also returns the point index where each segment after the first starts.
+        """
+        table=self.protocolTable(channel)
+        sweeps=np.arange(self.sweeps)[:,np.newaxis]
+        if table is None or not len(table['level']):
+            return np.full((self.sweeps,1),float(self.holding)),np.array([],dtype=int)
+        levels=table['level']+table['inc']*sweeps # broadcast (sweeps x epochs)
+        final=levels[:,-1:] if table['holdLast'] else np.full((self.sweeps,1),table['holding'])
+        holding=np.full((self.sweeps,1),float(table['holding']))
+        edges=np.concatenate(([self.offsetX],table['end']))
+        return np.hstack((holding,levels,final)),edges
+
+    def commandValues(self,timePoint=0,sweep=None,channel=None):
+        """
+        return the command value at a time point (sec, within sweep) for
+        one sweep, or for every sweep (as an array) if sweep is None.
+        """
+        levels,edges=self.commandLevels(channel)
+        segment=np.searchsorted(edges,int(timePoint*self.pointsPerSec),side='right')
+        if sweep is None:
+            return levels[:,segment]
+        return levels[sweep,segment]
+
+    def commandMatrix(self,channel=None):
+        """
+        return the command waveform (mV or pA) of every sweep as a 2D array
+        (sweeps x points). Useful for I/V curves and gain functions.
+        """
+        levels,edges=self.commandLevels(channel)
+        segments=np.searchsorted(edges,np.arange(self.sweepSize),side='right')
+        return levels[:,segments]
+
+    def generate_protocol(self,sweep=None):
+        """
+        Recreate the command stimulus (protocol) of a sweep (the current one
+        if not given) from the compiled epoch table. It's not stored point by
+        point (that's a waste of time and memory!) Instead it's a few (x,y)
+        points which can be easily graphed, returned as a dict with protoX,
+        protoY (for plotting) and protoSeqX, protoSeqY (condensed sequence).
+        Reading abf.protoX (etc.) does this for the current sweep as needed.
+        """
+        sweep=self.sweep if sweep is None else sweep
+        table=self.protocolTable()
 
         # if there's not a header, get out of here!
-        if not len(self.header['dictEpochInfoPerDAC']):
+        if table is None:
             self.log.debug("no protocol defined, so I'll make one")
-            self.protoX,self.protoY=[0,self.sweepX[-1]],[self.holding,self.holding]
-            self.protoSeqX,self.protoSeqY=[0],[self.holding]
-            return
-
-        # load our protocol from the header
-        proto=self.header['dictEpochInfoPerDAC'][self.channel]
-
-        # prepare our (x,y) pair arrays
-        self.protoX,self.protoY=[] ,[]
-
-        # assume our zero time point is the "holding" value
-        self.protoX.append(0)
-        self.protoY.append(self.holding) #TODO: what is this???
-
-        # now add x,y points for each change in the protocol
-        for step in proto:
-            dX = proto[step]['lEpochInitDuration']
-            Y = proto[step]['fEpochInitLevel']+proto[step]['fEpochLevelInc']*self.sweep
-            # we have a new Y value, so add it to the last time point
-            self.protoX.append(self.protoX[-1])
-            self.protoY.append(Y)
-            # now add the same Y point after "dX" amount of time
-            self.protoX.append(self.protoX[-1]+dX)
-            self.protoY.append(Y)
-            # TODO: detect ramps and warn what's up
-
-        # The last point is probably holding current
-        finalVal=self.holding #regular holding
-        # although if it's set to "use last value", maybe that should be the last one
-        if self.header['listDACInfo'][0]['nInterEpisodeLevel']:
-            finalVal=self.protoY[-1]
-
-        # add the shift to the final value to the list
-        self.protoX.append(self.protoX[-1])
-        self.protoY.append(finalVal)
-        # and again as the very last time point
-        self.protoX.append(self.sweepSize)
-        self.protoY.append(finalVal)
-
-        # update the sequence of protocols now (eliminate duplicate entries)
-        for i in range(1,len(self.protoX)-1): #correct for weird ABF offset issue.
-            self.protoX[i]=self.protoX[i]+self.offsetX
-        self.protoSeqY=[self.protoY[0]]
-        self.protoSeqX=[self.protoX[0]]
-        for i in range(1,len(self.protoY)):
-            if not self.protoY[i]==self.protoY[i-1]:
-                self.protoSeqY.append(self.protoY[i])
-                self.protoSeqX.append(self.protoX[i])
-        if self.protoY[0]!=self.protoY[1]:
-            self.protoY.insert(1,self.protoY[0])
-            self.protoX.insert(1,self.protoX[1])
-            self.protoY.insert(1,self.protoY[0])
-            self.protoX.insert(1,self.protoX[0]+self.offsetX/2)
-        self.protoSeqY.append(finalVal)
-        self.protoSeqX.append(self.sweepSize)
-
-        # convert lists to numpy arrays and do any final conversions
-        self.protoX=np.array(self.protoX)/self.pointsPerSec
-        self.protoY=np.array(self.protoY)
+            lastX=self.sweepX2[-1]+sweep*self.sweepInterval
+            return {'protoX':[0,lastX],'protoY':[self.holding,self.holding],
+                    'protoSeqX':[0],'protoSeqY':[self.holding]}
+
+        # (x,y) pairs at the start and end of every epoch, starting at holding
+        levels,edges=self.commandLevels()
+        levels=levels[sweep]
+        Y=np.concatenate(([self.holding],np.repeat(levels[1:-1],2),levels[-1:]*[1,1]))
+        X=np.concatenate(([0],np.column_stack((table['start'],table['end'])).ravel(),
+                          edges[-1:],[self.sweepSize]))
+
+        # the condensed sequence of protocols (eliminate duplicate entries)
+        keep=np.concatenate(([True],Y[1:]!=Y[:-1]))
+        seqX=list(X[keep])+[self.sweepSize]
+        seqY=list(Y[keep])+[levels[-1]]
+
+        # make the first step square
+        if Y[0]!=Y[1]:
+            X=np.concatenate((X[:1],X[:1]+self.offsetX/2,X[1:2],X[1:]))
+            Y=np.concatenate((Y[:1],Y[:1],Y[:1],Y[1:]))
+
+        return {'protoX':X/self.pointsPerSec,'protoY':Y,
+                'protoSeqX':seqX,'protoSeqY':seqY}
+
+    def protocolCurrent(self):
+        """generate (and remember) the protocol of the current sweep."""
+        key=(self.sweep,self.channel)
+        if getattr(self,'protocolCache',(None,))[0]!=key:
+            self.protocolCache=(key,self.generate_protocol())
+        return self.protocolCache[1]
+
+    protoX=property(lambda self: self.protocolCurrent()['protoX'])
+    protoY=property(lambda self: self.protocolCurrent()['protoY'])
+    protoSeqX=property(lambda self: self.protocolCurrent()['protoSeqX'])
+    protoSeqY=property(lambda self: self.protocolCurrent()['protoSeqY'])
+
+    def protocolEpochs(self):
+        """
+        return the epochs of the DAC which matches the current channel.
+        Channels without their own DAC (monitor channels, etc.) use DAC 0.
+        """
+        epochs=self.header['dictEpochInfoPerDAC']
+        if self.channel in epochs:
+            return epochs[self.channel]
+        return epochs[min(epochs)]
 
     def get_protocol(self,sweep):
         """
@@ -294,8 +1199,8 @@ class ABF:
         This is good for plotting/recreating the protocol trace.
         There may be duplicate numbers.
         """
-        self.setsweep(sweep)
-        return list(self.protoX),list(self.protoY)
+        proto=self.generate_protocol(sweep)
+        return list(proto['protoX']),list(proto['protoY'])
 
     def get_protocol_sequence(self,sweep):
         """
@@ -303,16 +1208,15 @@ class ABF:
         This is better for comparing similarities and determining steps.
         There should be no duplicate numbers.
         """
-        self.setsweep(sweep)
-        return list(self.protoSeqX),list(self.protoSeqY)
+        proto=self.generate_protocol(sweep)
+        return list(proto['protoSeqX']),list(proto['protoSeqY'])
 
     def clamp_values(self,timePoint=0):
         """
         return an array of command values at a time point (in sec).
         Useful for things like generating I/V curves.
         """
-        print("proto_clamp_at_time NOT YET IMPLIMENTED") #TODO:
-        return 0
+        return self.commandValues(timePoint)
 
     def epochTimes(self,nEpoch=2):
         """
@@ -323,7 +1227,7 @@ class ABF:
         """
         times=[]
         durations=[]
-        for epoch in self.header['dictEpochInfoPerDAC'][self.channel].values():
+        for epoch in self.protocolEpochs().values():
             print(epoch['lEpochInitDuration']/self.pointsPerSec)
             times.append(sum(durations))
             durations.append(epoch['lEpochInitDuration']/self.pointsPerSec)
@@ -336,10 +1240,17 @@ class ABF:
 
     ### advanced data access
 
-    def average(self,t1=0,t2=None,setsweep=False):
-        """return the average of part of the current sweep."""
+    def average(self,t1=0,t2=None,setsweep=False,channel=None):
+        """
+        return the average of part of the current sweep.
+        If a channel is given, average that channel of the current sweep
+        without changing which channel is selected.
+        """
         if setsweep:
             self.setsweep(setsweep)
+        if channel is not None and channel!=self.channel:
+            t2=self.sweepLength if t2 is None else t2
+            return self.getSweep(self.sweep,channel).average(t1,t2)
         if t2 is None or t2>self.sweepLength:
             t2=self.sweepLength
             self.log.debug("resetting t2 to [%f]",t2)
@@ -352,36 +1263,210 @@ class ABF:
             return np.nan
         return np.average(self.sweepY[I1:I2])
 
-    def averageSweep(self,sweepFirst=0,sweepLast=None):
+    def averageSweep(self,sweepFirst=0,sweepLast=None,channel=None):
         """
         Return a sweep which is the average of multiple sweeps.
-        For now, standard deviation is lost.
+        Uses the current channel unless another one is given.
+        See sweepStats() for the standard deviation, etc.
         """
         if sweepLast is None:
             sweepLast=self.sweeps-1
-        nSweeps=sweepLast-sweepFirst+1
-        runningSum=np.zeros(len(self.sweepY))
-        self.log.debug("averaging sweep %d to %d",sweepFirst,sweepLast)
-        for sweep in np.arange(nSweeps)+sweepFirst:
-            self.setsweep(sweep)
-            runningSum+=self.sweepY.flatten()
-        average=runningSum/nSweeps
-        #TODO: standard deviation?
-        return average
+        if channel is None:
+            channel=self.channel
+        self.log.debug("averaging sweep %d to %d (Ch%d)",sweepFirst,sweepLast,channel)
+        sweeps=self.sweepMatrix(channel,scaled=False)[int(sweepFirst):int(sweepLast)+1]
+        average=np.mean(sweeps,axis=0,dtype=float)
+        return self.toUnits(average,channel)
+
+    def sweepStats(self,sweeps=None,t1=None,t2=None,channel=None,
+                   baseline=None,weights=None):
+        """
+        Describe many sweeps point by point in a single pass. Returns a dict
+        of traces: mean, sd, sem, min, max, and count (sweeps with data at
+        each point, NaNs are skipped), plus X (time within the sweep, sec).
+
+            sweeps - sweep numbers (default every sweep)
+            t1, t2 - limit the traces to this time range (sec, within sweep)
+            baseline - (t1, t2) to subtract the average of from each sweep
+            weights - how much each sweep counts (SD and SEM treat them as
+                      reliability weights, so they don't have to add up)
+
+        If the sweeps are stored as one array (see recordingView) they're
+        reduced a block of STATS_POINTS points at a time, otherwise they're read one at a time and
+        accumulated (Welford's method) so only one is in memory at a time.
+        """
+        channel=self.channel if channel is None else channel
+        sweeps=np.arange(self.sweeps) if sweeps is None else np.array(list(sweeps),dtype=int)
+        if not len(sweeps):
+            raise ValueError("no sweeps to describe")
+        weights=np.ones(len(sweeps)) if weights is None else np.array(weights,dtype=float)
+        I1=None if t1 is None else max(0,int(t1*self.pointsPerSec))
+        I2=None if t2 is None else max(0,int(t2*self.pointsPerSec))
+        offsets=np.zeros(len(sweeps))
+        if baseline:
+            B1,B2=[max(0,int(t*self.pointsPerSec)) for t in baseline]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if self.recordingView(channel) is not None: # reduce the matrix
+                matrix=self.sweepMatrixPoints(channel,I1,I2,False) # a view
+                if baseline:
+                    data=self.toUnits(self.sweepMatrixPoints(channel,B1,B2,False)[sweeps],channel)
+                    offsets=np.nanmean(data,axis=1,dtype=float)
+                points=matrix.shape[1]
+                count,sumW,sumW2=np.zeros(points,dtype=int),np.zeros(points),np.zeros(points)
+                mean,S,low,high=np.zeros(points),np.zeros(points),np.zeros(points),np.zeros(points)
+                for J1 in range(0,points,STATS_POINTS): # a block of points at a time
+                    J2=min(points,J1+STATS_POINTS)
+                    Y=self.toUnits(matrix[sweeps,J1:J2],channel)-offsets[:,None]
+                    valid=~np.isnan(Y)
+                    W=np.where(valid,weights[:,None],0)
+                    count[J1:J2],sumW[J1:J2],sumW2[J1:J2]=valid.sum(axis=0),W.sum(axis=0),(W**2).sum(axis=0)
+                    mean[J1:J2]=np.nansum(W*Y,axis=0)/sumW[J1:J2]
+                    S[J1:J2]=np.nansum(W*(Y-mean[J1:J2])**2,axis=0)
+                    low[J1:J2],high[J1:J2]=np.nanmin(Y,axis=0),np.nanmax(Y,axis=0)
+            else: # stream sweeps through a running (weighted) accumulator
+                for i,sweep in enumerate(sweeps):
+                    data=self.sweepStored(sweep,channel)
+                    if baseline:
+                        offsets[i]=np.nanmean(self.toUnits(data[B1:B2].astype(float),channel))
+                    y=self.toUnits(data[I1:I2].astype(float),channel)-offsets[i]
+                    valid=~np.isnan(y)
+                    w=np.where(valid,weights[i],0)
+                    if i==0:
+                        count,sumW,sumW2=np.zeros(len(y),dtype=int),np.zeros(len(y)),np.zeros(len(y))
+                        mean,S=np.zeros(len(y)),np.zeros(len(y))
+                        low,high=np.full(len(y),np.nan),np.full(len(y),np.nan)
+                    count+=valid
+                    sumW+=w
+                    sumW2+=w**2
+                    delta=np.where(valid,y-mean,0)
+                    mean+=np.where(sumW>0,w/sumW,0)*delta
+                    S+=w*delta*np.where(valid,y-mean,0)
+                    low,high=np.fmin(low,y),np.fmax(high,y)
+                mean[sumW==0]=np.nan
+            sd=np.sqrt(S/(sumW-sumW2/sumW)) # unbiased (n-1 for equal weights)
+            sem=sd/np.sqrt(sumW**2/sumW2) # effective number of sweeps
+        return {"mean":mean,"sd":sd,"sem":sem,"min":low,"max":high,
+                "count":count,"X":self.timeBase()[I1:I2][:len(mean)]}
+
+    def sweepMatrix(self,channel=0,t1=None,t2=None,scaled=True):
+        """
+        Return every sweep of a channel as a 2D array (sweeps x points),
+        optionally limited to the time between t1 and t2 (sec, within sweep).
+        With the native reader this is a view of the file (no copying) for
+        floating point ABFs. Otherwise it's built in one allocation.
+        Treat it as read-only: it may share memory with the ABF.
+        If scaled is False, raw ABFs return raw samples (see toUnits()).
+        """
+        I1=None if t1 is None else max(0,int(t1*self.pointsPerSec))
+        I2=None if t2 is None else max(0,int(t2*self.pointsPerSec))
+        return self.sweepMatrixPoints(channel,I1,I2,scaled)
+
+    def sweepMatrixPoints(self,channel=0,I1=None,I2=None,scaled=True):
+        """sweepMatrix() limited to the points between indexes I1 and I2."""
+        if self.diskCache is not None:
+            matrix=self.diskCache[channel,:,I1:I2]
+        elif self.backend=="native" and self.raw:
+            matrix=self.ABFreader.data[:,I1:I2,channel]
+        elif self.backend=="native":
+            return self.ABFreader.matrix(channel,I1,I2,self.dtype)
+        else:
+            first=self.sweepStored(0,channel)[I1:I2]
+            matrix=np.empty((self.sweeps,len(first)),dtype=first.dtype)
+            matrix[0]=first
+            for sweep in range(1,self.sweeps):
+                matrix[sweep]=self.sweepStored(sweep,channel)[I1:I2]
+        return self.toUnits(matrix,channel) if scaled else matrix
+
+    def sweepStack(self,t1=None,t2=None,scaled=True):
+        """
+        Return every sweep of every channel as a 3D array
+        (channels x sweeps x points), optionally limited to the time between
+        t1 and t2 (sec, within sweep). stack[channel] is what
+        sweepMatrix(channel) returns. The file is read once for all channels,
+        and with the native reader floating point ABFs come back as a view.
+        Treat it as read-only: it may share memory with the ABF.
+        If scaled is False, raw ABFs return raw samples (see toUnits()).
+        """
+        I1=None if t1 is None else max(0,int(t1*self.pointsPerSec))
+        I2=None if t2 is None else max(0,int(t2*self.pointsPerSec))
+        if self.diskCache is not None:
+            stack=self.diskCache[:,:,I1:I2]
+        elif self.backend=="native" and self.raw:
+            stack=self.ABFreader.data[:,I1:I2].transpose(2,0,1)
+        elif self.backend=="native":
+            return self.ABFreader.stack(I1,I2,self.dtype)
+        else:
+            sweeps=[self.decodeSweepChannels(x)[:,I1:I2] for x in range(self.sweeps)]
+            stack=np.stack(sweeps,axis=1)
+        return self.toUnits(stack) if scaled else stack
+
+    def channelAverages(self,t1=0,t2=None):
+        """
+        return the average of every sweep of every channel between two times
+        (sec, within sweep) as a 2D array (channels x sweeps).
+        """
+        averages=np.mean(self.sweepStack(t1,t2,scaled=False),axis=2,dtype=float)
+        return self.toUnits(averages)
+
+    def measure(self,ranges=None,stats=None,channel=None,sweeps=None):
+        """
+        Measure every sweep in several time ranges (sec, within sweep, the
+        whole sweep by default) at once. stats are names from
+        core.MEASUREMENTS (mean, std, min, max, area, peak, slope), just
+        the mean by default. Returns (values, labels), where values is a 3D
+        array (sweeps x ranges x stats) and labels is a dict of the sweeps,
+        ranges, and stats along each axis. Ranges with no points give NaN.
+        A range from None starts at 0, and one to None ends with the sweep.
+
+            values,labels=abf.measure([(0,.1),(.5,1)],['mean','std'])
+            baseline,response=values[:,0,0],values[:,1,0]
+        """
+        ranges=[(0,None)] if ranges is None else ranges
+        stats=['mean'] if stats is None else stats
+        for stat in stats:
+            if not stat in MEASUREMENTS:
+                raise ValueError("unknown measurement [%s]"%stat)
+        channel=self.channel if channel is None else channel
+        sweeps=np.arange(self.sweeps) if sweeps is None else np.array(list(sweeps),dtype=int)
+        ranges=[(0 if t1 is None else t1,self.sweepLength if t2 is None else t2)
+                for t1,t2 in ranges]
+        indexes=[[min(self.sweepSize,max(0,int(t*self.pointsPerSec))) for t in x] for x in ranges]
+        values=np.full((len(sweeps),len(ranges),len(stats)),np.nan)
+        if not len(sweeps) or not len(ranges):
+            return values,{"sweeps":sweeps,"ranges":ranges,"stats":list(stats)}
+        first=min([x[0] for x in indexes])
+        last=max([x[1] for x in indexes])
+        matrix=self.sweepMatrixPoints(channel,first,last,False)[sweeps] # read once
+        for i,(I1,I2) in enumerate(indexes):
+            if I2<=I1:
+                continue
+            data=self.toUnits(matrix[:,I1-first:I2-first].astype(float),channel)
+            for j,stat in enumerate(stats):
+                values[:,i,j]=MEASUREMENTS[stat](data,self)
+        return values,{"sweeps":sweeps,"ranges":ranges,"stats":list(stats)}
 
     def kernel_gaussian(self, sizeMS, sigmaMS=None, forwardOnly=False):
         """create kernel based on this ABF info."""
         sigmaMS=sizeMS/10 if sigmaMS is None else sigmaMS
         size,sigma=sizeMS*self.pointsPerMs,sigmaMS*self.pointsPerMs
         self.kernel=swhlab.common.kernel_gaussian(size,sigma,forwardOnly)
+        self.kernelInfo=(self.kernel,sigma,forwardOnly)
         return self.kernel
 
-    def sweepYfiltered(self):
+    def sweepYfiltered(self,smoother=None):
         """
         Get the filtered sweepY of the current sweep.
         Only works if self.kernel has been generated.
+        If smoother (or common.SMOOTHER) is "boxes" and the kernel came from
+        kernel_gaussian(), a box filter cascade stands in for it (faster
+        for wide kernels, see common.smoothBoxes).
         """
         assert self.kernel is not None
+        smoother=smoother or swhlab.common.SMOOTHER
+        if smoother=="boxes" and self.kernelInfo and self.kernelInfo[0] is self.kernel:
+            kernel,sigma,forwardOnly=self.kernelInfo
+            if not forwardOnly:
+                return swhlab.common.smoothBoxes(self.sweepY,sigma)
         return swhlab.common.convolve(self.sweepY,self.kernel)
 
     def sweepYsmartbase(self):
@@ -474,6 +1559,70 @@ class ABF:
         headerFile=r"C:\Users\swharden\Documents\temp\header.html"
         headerHTML(self.header,headerFile)
 
+    def clone(self):
+        """
+        return a new ABF object which shares this one's data (file, header)
+        but can select its own sweep and channel. The clone holds on to the
+        original ABF (as master) so the shared data outlives it.
+        """
+        return ABF(self)
+
+    def cloneState(self):
+        """
+        give a freshly cloned ABF its own current sweep, prefetch queue, and
+        read-only views of shared memory-mapped data, so nothing one clone
+        does can change what another clone sees. Decoded sweeps and derived
+        signals are read-only, so the master's caches of them (which are
+        thread safe) are shared and each sweep is decoded only once.
+        """
+        self.prefetched={}
+        self.pyramids={}
+        self.__dict__.pop('protocolCache',None)
+        if self.diskCache is not None:
+            self.diskCache=self.diskCache.view()
+            self.diskCache.flags.writeable=False
+        if self.backend=="native" and self.ABFreader.data is not None:
+            self.ABFreader=copy.copy(self.ABFreader) # same file, its own view
+            self.ABFreader.data=self.ABFreader.data.view()
+            self.ABFreader.data.flags.writeable=False
+        self.sweepY=np.array(self.sweepY)
+        self.sweepInfo=Sweep(self,self.sweep,self.channel,self.sweepY)
+        if self.sweepCurrent is not None:
+            self.sweepCurrent=Sweep(self,self.sweep,self.channel,self.sweepCurrent.Y)
+
+### process-wide cache of opened ABFs
+
+abfCache=swhlab.common.LRU(ABF_CACHE) # recently opened ABFs
+abfAlive=weakref.WeakValueDictionary() # opened ABFs still in use somewhere
+
+def cachedABF(fname,**kwargs):
+    """
+    Return a clone of an ABF, opening the file only if it hasn't been opened
+    already. Opened ABFs are remembered by absolute filename (and keyword
+    arguments). The last ABF_CACHE of them are kept, as are any which clones
+    still hold on to (as their master). If the file changed on disk since it
+    was opened, it's reopened.
+    Given an ABF object, a clone of it is returned.
+    """
+    if "ABF object" in str(fname):
+        return ABF(fname)
+    path=os.path.abspath(str(fname))
+    if not os.path.exists(path):
+        return ABF(fname,**kwargs) # let ABF() complain about it
+    stat=os.stat(path)
+    fileID=(stat.st_size,stat.st_mtime)
+    key=(path,)+tuple(sorted(kwargs.items()))
+    abfCache.maxItems=ABF_CACHE
+    abf=abfCache.get(key)
+    if abf is None:
+        abf=abfAlive.get(key)
+    if abf is None or abf.fileStat!=fileID:
+        abf=ABF(path,**kwargs)
+        abf.fileStat=fileID
+        abfAlive[key]=abf
+    abfCache[key]=abf
+    return ABF(abf)
+
 
 
 if __name__=="__main__":
@@ -95,6 +95,24 @@ class INDEX:
         self.log.debug("folder2 has %d files",len(self.files2))
         self.log.debug("scanning folders took %s",cm.timeit(t1)) # ~200ms
 
+    def scanHeaders(self):
+        """
+        read the header of every ABF in folder1 into self.headers (by ID).
+        Only headers are read, so this is fast even for huge folders.
+        ABFs whose headers can't be read are listed in self.headersBad.
+        """
+        t1=cm.timeit()
+        self.headers,self.headersBad={},[]
+        for fname in self.files1abf:
+            try:
+                header=swhlab.ABFHeader(os.path.join(self.folder1,fname))
+                self.headers[fname[:-4]]=header
+            except Exception as e:
+                self.log.error("can't read header of [%s] (%s)",fname,e)
+                self.headersBad.append(fname[:-4])
+        self.log.debug("reading %d headers took %s",len(self.headers),cm.timeit(t1))
+        return self.headers
+
     ### DATA ANALYSIS AND CONVERSION
 
     def convertImages(self):
@@ -131,10 +149,22 @@ class INDEX:
                 self.log.error("orphan image: %s",fname)
 
     def analyzeAll(self):
-        """analyze every unanalyzed ABF in the folder."""
+        """
+        analyze every unanalyzed ABF in the folder.
+        ABFs which fail swhlab.validate() (truncated, etc.) are skipped.
+        """
         searchableData=str(self.files2)
         self.log.debug("considering analysis for %d ABFs",len(self.IDs))
+        needed=[ID for ID in self.IDs if not ID+"_" in searchableData]
+        self.invalid=[]
+        for result in swhlab.validate([os.path.join(self.folder1,ID+".abf") for ID in needed]):
+            if not result["ok"]:
+                ID=os.path.basename(result["path"])[:-4]
+                self.log.error("skipping invalid ABF [%s] (%s)",ID,"; ".join(result["problems"]))
+                self.invalid.append(ID)
         for ID in self.IDs:
+            if ID in self.invalid:
+                continue
             if not ID+"_" in searchableData:
                 self.log.debug("%s needs analysis",ID)
                 try:
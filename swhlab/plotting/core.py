@@ -142,9 +142,10 @@ class ABFplot:
             fraction=1-fraction
         return cm(fraction)
 
-    def setColorBySweep(self):
+    def setColorBySweep(self,sweep=None):
+        sweep=self.abf.sweep if sweep is None else sweep
         if self.rainbow:
-            self.kwargs["color"]=self.getColor(self.abf.sweep/self.abf.sweeps)
+            self.kwargs["color"]=self.getColor(sweep/self.abf.sweeps)
         else:
             self.kwargs["color"]=self.traceColor
     ### plot modifications
@@ -185,16 +186,26 @@ class ABFplot:
     ### figure creation
 
     def figure_chronological(self):
-        """plot every sweep of an ABF file (with comments)."""
+        """
+        plot every sweep of an ABF file (with comments).
+        Long sweeps are drawn as a min/max envelope (see ABF.envelope) with
+        as many points as the saved image is wide, which looks the same.
+        """
         self.log.debug("creating chronological plot")
         self.figure()
+        pixels=self.figure_width*self.figure_dpi/self.abf.sweeps # per sweep
         for sweep in range(self.abf.sweeps):
-            self.abf.setsweep(sweep)
-            self.setColorBySweep()
+            self.setColorBySweep(sweep)
             if self.abf.derivative:
+                self.abf.setsweep(sweep)
                 plt.plot(self.abf.sweepX,self.abf.sweepD,**self.kwargs)
+                continue
+            T,Ymin,Ymax=self.abf.envelope(sweep*self.abf.sweepLength,
+                                          (sweep+1)*self.abf.sweepLength,pixels)
+            if Ymin is Ymax:
+                plt.plot(T,Ymin,**self.kwargs)
             else:
-                plt.plot(self.abf.sweepX,self.abf.sweepY,**self.kwargs)
+                plt.fill_between(T,Ymin,Ymax,**self.kwargs)
         self.comments()
         self.decorate()
 
@@ -219,6 +230,18 @@ class ABFplot:
             self.marginX=.05
         self.decorate()
 
+    def figure_channels(self,sweep=0):
+        """plot one sweep of every channel (one subplot per channel)."""
+        self.log.debug("plotting sweep %d of %d channels",sweep,self.abf.channels)
+        self.figure()
+        channel=self.abf.channel
+        for i in range(self.abf.channels):
+            plt.subplot(self.abf.channels,1,i+1)
+            self.abf.setsweep(sweep,i) # so decorate() labels the right units
+            plt.plot(self.abf.sweepX2,self.abf.sweepY,**self.kwargs)
+            self.decorate()
+        self.abf.setsweep(sweep,channel) # leave it how we found it
+
     def figure_protocol(self):
         """plot the current sweep protocol."""
         self.log.debug("creating overlayed protocols plot")
@@ -0,0 +1,599 @@
+"""
+Native ABF1/ABF2 file access (neo is not required).
+
+The header is parsed directly with struct and the data section is memory
+mapped, so opening an ABF costs the same no matter how long the recording is.
+Sweeps are served as numpy views of the memory-mapped data (shaped
+sweeps x points x channels) and nothing is decoded until it is asked for.
+
+The header is presented as a dict with the same keys NeoIO uses
+(listADCInfo, listDACInfo, dictEpochInfoPerDAC, protocol, ...) so code which
+reads abf.header works with either backend.
+
+validate() checks whole folders of ABFs for truncated or corrupted files
+(in parallel) without decoding any data.
+"""
+
+import os
+import glob
+import ntpath
+import struct
+import hashlib
+import datetime
+import concurrent.futures
+import numpy as np
+
+BLOCKSIZE=512 # ABF files are organized in 512 byte blocks
+READ_BYTES=2**22 # validate() reads files in chunks this big
+FIXED_LENGTH_MODES=[2,4,5] # operation modes whose sweeps are all the same length
+
+### structure definitions (name, format) in the order they appear on disk
+
+ABF2_SECTIONS="""ProtocolSection ADCSection DACSection EpochSection
+ADCPerDACSection EpochPerDACSection UserListSection StatsRegionSection
+MathSection StringsSection DataSection TagSection ScopeSection DeltaSection
+VoiceTagSection SynchArraySection AnnotationSection StatsSection""".split()
+
+ABF2_HEADER=[
+    ('fFileSignature','4s'),('fFileVersionNumber','4B'),('uFileInfoSize','I'),
+    ('lActualEpisodes','I'),('uFileStartDate','I'),('uFileStartTimeMS','I'),
+    ('uStopwatchTime','I'),('nFileType','H'),('nDataFormat','H'),
+    ('nSimultaneousScan','H'),('nCRCEnable','H'),('uFileCRC','I'),
+    ('FileGUID','16s'),('uCreatorVersion','I'),('uCreatorNameIndex','I'),
+    ('uModifierVersion','I'),('uModifierNameIndex','I'),
+    ('uProtocolPathIndex','I'),
+    ]
+
+ABF2_PROTOCOL=[
+    ('nOperationMode','h'),('fADCSequenceInterval','f'),
+    ('bEnableFileCompression','b'),('sUnused1','3s'),
+    ('uFileCompressionRatio','I'),('fSynchTimeUnit','f'),
+    ('fSecondsPerRun','f'),('lNumSamplesPerEpisode','i'),
+    ('lPreTriggerSamples','i'),('lEpisodesPerRun','i'),('lRunsPerTrial','i'),
+    ('lNumberOfTrials','i'),('nAveragingMode','h'),('nUndoRunCount','h'),
+    ('nFirstEpisodeInRun','h'),('fTriggerThreshold','f'),
+    ('nTriggerSource','h'),('nTriggerAction','h'),('nTriggerPolarity','h'),
+    ('fScopeOutputInterval','f'),('fEpisodeStartToStart','f'),
+    ('fRunStartToStart','f'),('lAverageCount','i'),('fTrialStartToStart','f'),
+    ('nAutoTriggerStrategy','h'),('fFirstRunDelayS','f'),
+    ('nChannelStatsStrategy','h'),('lSamplesPerTrace','i'),
+    ('lStartDisplayNum','i'),('lFinishDisplayNum','i'),('nShowPNRawData','h'),
+    ('fStatisticsPeriod','f'),('lStatisticsMeasurements','i'),
+    ('nStatisticsSaveStrategy','h'),('fADCRange','f'),('fDACRange','f'),
+    ('lADCResolution','i'),('lDACResolution','i'),('nExperimentType','h'),
+    ('nManualInfoStrategy','h'),('nCommentsEnable','h'),
+    ('lFileCommentIndex','i'),
+    ]
+
+ABF2_ADC=[
+    ('nADCNum','h'),('nTelegraphEnable','h'),('nTelegraphInstrument','h'),
+    ('fTelegraphAdditGain','f'),('fTelegraphFilter','f'),
+    ('fTelegraphMembraneCap','f'),('nTelegraphMode','h'),
+    ('fTelegraphAccessResistance','f'),('nADCPtoLChannelMap','h'),
+    ('nADCSamplingSeq','h'),('fADCProgrammableGain','f'),
+    ('fADCDisplayAmplification','f'),('fADCDisplayOffset','f'),
+    ('fInstrumentScaleFactor','f'),('fInstrumentOffset','f'),
+    ('fSignalGain','f'),('fSignalOffset','f'),('fSignalLowpassFilter','f'),
+    ('fSignalHighpassFilter','f'),('nLowpassFilterType','b'),
+    ('nHighpassFilterType','b'),('fPostProcessLowpassFilter','f'),
+    ('nPostProcessLowpassFilterType','b'),('bEnabledDuringPN','b'),
+    ('nStatsChannelPolarity','h'),('lADCChannelNameIndex','i'),
+    ('lADCUnitsIndex','i'),
+    ]
+
+ABF2_DAC=[
+    ('nDACNum','h'),('nTelegraphDACScaleFactorEnable','h'),
+    ('fInstrumentHoldingLevel','f'),('fDACScaleFactor','f'),
+    ('fDACHoldingLevel','f'),('fDACCalibrationFactor','f'),
+    ('fDACCalibrationOffset','f'),('lDACChannelNameIndex','i'),
+    ('lDACChannelUnitsIndex','i'),('lDACFilePtr','i'),
+    ('lDACFileNumEpisodes','i'),('nWaveformEnable','h'),
+    ('nWaveformSource','h'),('nInterEpisodeLevel','h'),
+    ]
+
+ABF2_EPOCH=[
+    ('nEpochNum','h'),('nDACNum','h'),('nEpochType','h'),
+    ('fEpochInitLevel','f'),('fEpochLevelInc','f'),
+    ('lEpochInitDuration','i'),('lEpochDurationInc','i'),
+    ('lEpochPulsePeriod','i'),('lEpochPulseWidth','i'),
+    ]
+
+ABF_TAG=[
+    ('lTagTime','i'),('sComment','56s'),('nTagType','h'),
+    ('nVoiceTagNumberorAnnotationIndex','h'),
+    ]
+
+SYNCH_DTYPE=np.dtype([('lStart','<i4'),('lLength','<i4')])
+
+# ABF1 headers are one big structure. Only fields we use are listed here as
+# (name, format, byte offset). Fields beyond 2048 only exist in the extended
+# (6144 byte) header used by ABF 1.6 and newer.
+ABF1_FIELDS=[
+    ('fFileSignature','4s',0),('fFileVersionNumber','f',4),
+    ('nOperationMode','h',8),('lActualAcqLength','i',10),
+    ('nNumPointsIgnored','h',14),('lActualEpisodes','i',16),
+    ('lFileStartDate','i',20),('lFileStartTime','i',24),
+    ('lDataSectionPtr','i',40),('lTagSectionPtr','i',44),
+    ('lNumTagEntries','i',48),('lSynchArrayPtr','i',92),
+    ('lSynchArraySize','i',96),('nDataFormat','h',100),
+    ('nADCNumChannels','h',120),('fADCSampleInterval','f',122),
+    ('fSynchTimeUnit','f',130),('lNumSamplesPerEpisode','i',138),
+    ('fEpisodeStartToStart','f',178),('fADCRange','f',244),
+    ('lADCResolution','i',252),('nFileStartMillisecs','h',366),
+    ('nADCSamplingSeq','16h',410),('sADCChannelName','160s',442),
+    ('sADCUnits','128s',602),('fADCProgrammableGain','16f',730),
+    ('fInstrumentScaleFactor','16f',922),('fInstrumentOffset','16f',986),
+    ('fSignalGain','16f',1050),('fSignalOffset','16f',1114),
+    ('sDACChannelName','40s',1306),('sDACChannelUnits','32s',1346),
+    ('fDACHoldingLevel','4f',1394),
+    ]
+ABF1_FIELDS_EXTENDED=[
+    ('nInterEpisodeLevel','2h',2304),('nEpochType','20h',2308),
+    ('fEpochInitLevel','20f',2348),('fEpochLevelInc','20f',2428),
+    ('lEpochInitDuration','20i',2508),('lEpochDurationInc','20i',2588),
+    ('nTelegraphEnable','16h',4512),('fTelegraphAdditGain','16f',4576),
+    ('sProtocolPath','384s',4898),
+    ]
+ABF1_HEADER_EXTENDED=6144 # bytes
+STRINGS_HEADER=44 # bytes before the first string of the ABF2 strings section
+
+def _struct(fields):
+    """compile a list of (name, format) into a packed little-endian Struct."""
+    return struct.Struct("<"+"".join([x[1] for x in fields]))
+
+def _unpack(fields,compiled,raw,offset=0):
+    """unpack one structure into a dict. Array formats become lists."""
+    values=compiled.unpack_from(raw,offset)
+    if len(values)==len(fields): # no arrays, so values line up with names
+        return dict(zip([x[0] for x in fields],values))
+    result,i={},0
+    for name,fmt in fields:
+        count=int(fmt[:-1]) if len(fmt)>1 and not fmt.endswith('s') else 1
+        result[name]=values[i] if count==1 else list(values[i:i+count])
+        i+=count
+    return result
+
+STRUCT_ABF2_HEADER=_struct(ABF2_HEADER)
+STRUCT_ABF2_PROTOCOL=_struct(ABF2_PROTOCOL)
+STRUCT_ABF2_ADC=_struct(ABF2_ADC)
+STRUCT_ABF2_DAC=_struct(ABF2_DAC)
+STRUCT_ABF2_EPOCH=_struct(ABF2_EPOCH)
+STRUCT_TAG=_struct(ABF_TAG)
+STRUCT_SECTION=struct.Struct("<IIq")
+
+def _decode(raw):
+    """turn a fixed-width byte string from the header into a clean string."""
+    raw=raw.split(b'\x00')[0].replace(b'\xb5',b'u') # micro sign becomes u
+    return raw.decode('latin-1').strip()
+
+def _indexedStrings(raw):
+    """
+    ABF2 stores strings (units, channel names, protocol path) in one section
+    and the rest of the header refers to them by index (starting at 1).
+    """
+    if raw[:4]==b'SSCH' and len(raw)>=STRINGS_HEADER:
+        count,totalBytes=struct.unpack_from("<I4xi",raw,8)
+        if 0<totalBytes<=len(raw)-STRINGS_HEADER:
+            raw=raw[:STRINGS_HEADER+totalBytes]
+        parts=raw[STRINGS_HEADER:].split(b'\x00') # empty strings are real strings
+        if 0<count<=len(parts):
+            return ['']+[_decode(x) for x in parts[:count]]
+    raw=raw[raw.rfind(b'\x00\x00'):] # fall back to the pyABF method
+    return [_decode(x) for x in raw.split(b'\x00')]
+
+def _readHeaderV2(f):
+    """read the header of an ABF2 file into a neo-style header dict."""
+    raw=f.read(BLOCKSIZE)
+    header=_unpack(ABF2_HEADER,STRUCT_ABF2_HEADER,raw)
+    header['fFileVersionNumber']=float("%d.%d%d%d"%tuple(header['fFileVersionNumber'][::-1]))
+    sections={}
+    for i,name in enumerate(ABF2_SECTIONS):
+        uBlockIndex,uBytes,llNumEntries=STRUCT_SECTION.unpack_from(raw,76+i*16)
+        sections[name]={'uBlockIndex':uBlockIndex,'uBytes':uBytes,
+                        'llNumEntries':llNumEntries}
+    header['sections']=sections
+
+    def readSection(name):
+        """return the raw bytes of every entry of a section as a list."""
+        section=sections[name]
+        if not section['uBytes'] or not section['llNumEntries']:
+            return []
+        f.seek(section['uBlockIndex']*BLOCKSIZE)
+        raw=f.read(section['uBytes']*section['llNumEntries'])
+        return [raw[i*section['uBytes']:(i+1)*section['uBytes']]
+                for i in range(section['llNumEntries'])]
+
+    strings=readSection('StringsSection')
+    strings=_indexedStrings(strings[0]) if len(strings) else ['']
+    def string(index):
+        return strings[index] if 0<index<len(strings) else ''
+
+    header['protocol']=_unpack(ABF2_PROTOCOL,STRUCT_ABF2_PROTOCOL,readSection('ProtocolSection')[0])
+    header['sProtocolPath']=string(header['uProtocolPathIndex'])
+    header['sFileComment']=string(header['protocol']['lFileCommentIndex'])
+    header['listADCInfo']=[]
+    for raw in readSection('ADCSection'):
+        ADCInfo=_unpack(ABF2_ADC,STRUCT_ABF2_ADC,raw)
+        ADCInfo['ADCChNames']=string(ADCInfo['lADCChannelNameIndex'])
+        ADCInfo['ADCChUnits']=string(ADCInfo['lADCUnitsIndex'])
+        header['listADCInfo'].append(ADCInfo)
+    header['listDACInfo']=[]
+    for raw in readSection('DACSection'):
+        DACInfo=_unpack(ABF2_DAC,STRUCT_ABF2_DAC,raw)
+        DACInfo['DACChNames']=string(DACInfo['lDACChannelNameIndex'])
+        DACInfo['DACChUnits']=string(DACInfo['lDACChannelUnitsIndex'])
+        header['listDACInfo'].append(DACInfo)
+    header['dictEpochInfoPerDAC']={}
+    for raw in readSection('EpochPerDACSection'):
+        epoch=_unpack(ABF2_EPOCH,STRUCT_ABF2_EPOCH,raw)
+        header['dictEpochInfoPerDAC'].setdefault(epoch['nDACNum'],{})
+        header['dictEpochInfoPerDAC'][epoch['nDACNum']][epoch['nEpochNum']]=epoch
+    header['listTag']=[_unpack(ABF_TAG,STRUCT_TAG,raw) for raw in readSection('TagSection')]
+    header['synchArray']=np.frombuffer(b''.join(readSection('SynchArraySection')),dtype=SYNCH_DTYPE)
+
+    # describe the data section in a version-independent way
+    data=sections['DataSection']
+    header['dataOffset']=data['uBlockIndex']*BLOCKSIZE
+    header['dataPoints']=data['llNumEntries']
+    header['dataBytesPerPoint']=data['uBytes']
+    header['channels']=len(header['listADCInfo'])
+    header['rate']=1e6/header['protocol']['fADCSequenceInterval']
+    header['rec_datetime']=_datetime(header['uFileStartDate'],
+                                     header['uFileStartTimeMS']/1000.0)
+    return header
+
+def _readHeaderV1(f):
+    """read the header of an ABF1 file into a neo-style header dict."""
+    raw=f.read(ABF1_HEADER_EXTENDED)
+    header={}
+    fields=ABF1_FIELDS
+    if len(raw)>=ABF1_HEADER_EXTENDED:
+        if struct.unpack_from("<i",raw,40)[0]*BLOCKSIZE>=ABF1_HEADER_EXTENDED:
+            fields=fields+ABF1_FIELDS_EXTENDED
+    for name,fmt,offset in fields:
+        values=struct.unpack_from("<"+fmt,raw,offset)
+        header[name]=values[0] if len(values)==1 else list(values)
+    channels=header['nADCNumChannels']
+
+    # ABF1 stores settings for all 16 ADCs; keep only the ones recorded
+    header['listADCInfo']=[]
+    for i in range(channels):
+        adc=header['nADCSamplingSeq'][i]
+        ADCInfo={'nADCNum':adc}
+        for key in ['fADCProgrammableGain','fInstrumentScaleFactor',
+                    'fInstrumentOffset','fSignalGain','fSignalOffset',
+                    'nTelegraphEnable','fTelegraphAdditGain']:
+            ADCInfo[key]=header[key][adc] if key in header else 0
+        ADCInfo['ADCChNames']=_decode(header['sADCChannelName'][adc*10:adc*10+10])
+        ADCInfo['ADCChUnits']=_decode(header['sADCUnits'][adc*8:adc*8+8])
+        header['listADCInfo'].append(ADCInfo)
+    header['listDACInfo']=[]
+    for dac in range(4):
+        DACInfo={'nDACNum':dac,'fDACHoldingLevel':header['fDACHoldingLevel'][dac]}
+        DACInfo['nInterEpisodeLevel']=header.get('nInterEpisodeLevel',[0,0,0,0])[dac] if dac<2 else 0
+        DACInfo['DACChNames']=_decode(header['sDACChannelName'][dac*10:dac*10+10])
+        DACInfo['DACChUnits']=_decode(header['sDACChannelUnits'][dac*8:dac*8+8])
+        header['listDACInfo'].append(DACInfo)
+    header['dictEpochInfoPerDAC']={}
+    if 'nEpochType' in header:
+        for i,epochType in enumerate(header['nEpochType']):
+            if not epochType:
+                continue
+            dac,epochNum=divmod(i,10)
+            epoch={'nEpochNum':epochNum,'nDACNum':dac,'nEpochType':epochType}
+            for key in ['fEpochInitLevel','fEpochLevelInc','lEpochInitDuration','lEpochDurationInc']:
+                epoch[key]=header[key][i]
+            header['dictEpochInfoPerDAC'].setdefault(dac,{})[epochNum]=epoch
+    header['sProtocolPath']=_decode(header.get('sProtocolPath',b''))
+    header['protocol']={}
+    for key in ['nOperationMode','fSynchTimeUnit','lNumSamplesPerEpisode',
+                'fEpisodeStartToStart','fADCRange','lADCResolution']:
+        header['protocol'][key]=header[key]
+    header['protocol']['fADCSequenceInterval']=header['fADCSampleInterval']*channels
+
+    def readEntries(blockPtr,count,size):
+        if not blockPtr or count<=0:
+            return b''
+        f.seek(blockPtr*BLOCKSIZE)
+        raw=f.read(size*count)
+        return raw[:len(raw)-len(raw)%size]
+
+    raw=readEntries(header['lTagSectionPtr'],header['lNumTagEntries'],STRUCT_TAG.size)
+    header['listTag']=[_unpack(ABF_TAG,STRUCT_TAG,raw,i) for i in range(0,len(raw),STRUCT_TAG.size)]
+    raw=readEntries(header['lSynchArrayPtr'],header['lSynchArraySize'],SYNCH_DTYPE.itemsize)
+    header['synchArray']=np.frombuffer(raw,dtype=SYNCH_DTYPE)
+
+    # describe the data section in a version-independent way
+    header['dataBytesPerPoint']=4 if header['nDataFormat'] else 2
+    header['dataOffset']=header['lDataSectionPtr']*BLOCKSIZE+header['nNumPointsIgnored']*header['dataBytesPerPoint']
+    header['dataPoints']=header['lActualAcqLength']
+    header['channels']=channels
+    header['rate']=1e6/header['protocol']['fADCSequenceInterval']
+    date=header['lFileStartDate']
+    if date<1000000: # old files use YYMMDD
+        date+=19000000 if date>800000 else 20000000
+    header['rec_datetime']=_datetime(date,header['lFileStartTime']+header['nFileStartMillisecs']/1000.0)
+    return header
+
+def _datetime(yyyymmdd,seconds):
+    """convert an ABF date integer and seconds after midnight to a datetime."""
+    try:
+        yyyymmdd=int(yyyymmdd)
+        day=datetime.datetime(yyyymmdd//10000,yyyymmdd//100%100,yyyymmdd%100)
+        return day+datetime.timedelta(seconds=seconds)
+    except ValueError:
+        return None
+
+def readHeader(fname):
+    """return the header of an ABF1 or ABF2 file as a neo-style dict."""
+    with open(fname,'rb') as f:
+        signature=f.read(4)
+        f.seek(0)
+        if signature==b'ABF2':
+            header=_readHeaderV2(f)
+            header['abfVersion']=2
+        elif signature==b'ABF ':
+            header=_readHeaderV1(f)
+            header['abfVersion']=1
+        else:
+            raise ValueError("not an ABF file: %s"%fname)
+    return header
+
+class ABFHeader:
+    def __init__(self,fname):
+        """
+        Read just the header of an ABF (version 1 or 2). Sample data is never
+        touched, so this is fast enough to catalog thousands of files.
+
+        Useful attributes: protocol, protocolPath, sweeps, channels, rate,
+        sweepPoints, sweepLength, adcUnits, dacUnits, holding, epochs,
+        tagTimes, tagComments, timestamp. The full neo-style header dict
+        is available as header.
+        """
+        self.filename=os.path.abspath(fname)
+        self.ID=os.path.splitext(os.path.basename(self.filename))[0]
+        self.header=readHeader(self.filename)
+        header=self.header
+        self.abfVersion=header['abfVersion']
+        self.channels=header['channels']
+        self.rate=int(round(header['rate'])) # Hz
+        self.protocolPath=header['sProtocolPath']
+        self.protocol=ntpath.splitext(ntpath.basename(self.protocolPath))[0]
+        self.protocol=self.protocol.split(" ")[0] # just the protocol number
+        self.comment=header.get('sFileComment','')
+        self.timestamp=header['rec_datetime']
+        self.operationMode=header['protocol']['nOperationMode']
+
+        # sweep geometry (gap free recordings are treated as a single sweep)
+        if self.operationMode==3 or not header['lActualEpisodes']:
+            self.sweeps=1
+        else:
+            self.sweeps=header['lActualEpisodes']
+        self.sweepPoints=int(header['dataPoints']/self.sweeps/max(1,self.channels))
+        self.sweepLength=self.sweepPoints/self.rate # seconds
+
+        # per-channel information
+        self.adcNames=[x['ADCChNames'] for x in header['listADCInfo']]
+        self.adcUnits=[x['ADCChUnits'] for x in header['listADCInfo']]
+        self.dacUnits=[x['DACChUnits'] for x in header['listDACInfo']]
+        self.dacHolding=[x['fDACHoldingLevel'] for x in header['listDACInfo']]
+        self.holding=self.dacHolding[0] if len(self.dacHolding) else 0
+        self.epochs=header['dictEpochInfoPerDAC'] # epochs[DAC][epoch]
+
+        # sweep start times (sec) come from the synch array if it's sensible
+        self.sweepStarts=np.arange(self.sweeps)*self.sweepLength
+        synch=header['synchArray']
+        if self.sweeps>1 and len(synch)==self.sweeps:
+            self.sweepStarts=self._synchTime(synch['lStart'].astype(float))
+        self.length=self.sweepStarts[-1]+self.sweepLength # seconds
+
+        # comments (tags) in seconds from the start of the recording
+        self.tagTimes=self._synchTime(np.array([x['lTagTime'] for x in header['listTag']],dtype=float))
+        self.tagComments=[_decode(x['sComment']) for x in header['listTag']]
+
+    def _synchTime(self,ticks):
+        """convert times in synch time units (or samples) to seconds."""
+        synchTimeUnit=self.header['protocol']['fSynchTimeUnit']
+        if synchTimeUnit:
+            return ticks*synchTimeUnit/1e6
+        return ticks/max(1,self.channels)/self.rate
+
+    def __repr__(self):
+        return "<ABFHeader %s [%s] %d sweeps, %d channels, %d Hz>"%(
+            self.ID,self.protocol,self.sweeps,self.channels,self.rate)
+
+class ABFreader(ABFHeader):
+    def __init__(self,fname):
+        """
+        Open an ABF (version 1 or 2) without decoding any of its data.
+
+        Sweeps are exposed through sweep() as views of a memory-mapped array
+        shaped (sweeps, points, channels). The file is mapped copy-on-write,
+        so scripts which modify sweep data in place never touch the file.
+        Raises ValueError for files this reader can't interpret (variable
+        length event-driven sweeps, compressed files, etc).
+        """
+        ABFHeader.__init__(self,fname)
+        header=self.header
+        lengths=header['synchArray']['lLength']
+        if self.operationMode==1 or (self.sweeps>1 and len(lengths)==self.sweeps
+                                     and np.any(lengths!=lengths[0])):
+            raise ValueError("sweeps have different lengths")
+        if not self.channels or header['dataPoints']%(self.sweeps*self.channels):
+            raise ValueError("data section doesn't divide into equal sweeps")
+        fileSize=os.path.getsize(self.filename)
+        if header['dataOffset']+header['dataPoints']*header['dataBytesPerPoint']>fileSize:
+            raise ValueError("data section extends beyond the end of the file")
+        self.scale,self.offset=self._scaling()
+
+        # memory-map the data section (nothing is read from disk yet)
+        if header['dataBytesPerPoint']==2:
+            self.dtype=np.dtype('<i2')
+        elif header['dataBytesPerPoint']==4:
+            self.dtype=np.dtype('<f4')
+        else:
+            raise ValueError("unsupported data format")
+        self.data=np.memmap(self.filename,dtype=self.dtype,mode='c',
+                            offset=header['dataOffset'],
+                            shape=(self.sweeps,self.sweepPoints,self.channels))
+
+    def _scaling(self):
+        """return arrays of the scale and offset converting raw data to units."""
+        scale,offset=np.ones(self.channels),np.zeros(self.channels)
+        if self.header['dataBytesPerPoint']==4:
+            return scale,offset # floating point data is already scaled
+        protocol=self.header.get('protocol',{})
+        for i,ADCInfo in enumerate(self.header['listADCInfo']):
+            factor=protocol['fADCRange']/protocol['lADCResolution']
+            factor/=ADCInfo['fInstrumentScaleFactor']*ADCInfo['fSignalGain']
+            factor/=ADCInfo['fADCProgrammableGain']
+            if ADCInfo['nTelegraphEnable'] and ADCInfo['fTelegraphAdditGain']:
+                factor/=ADCInfo['fTelegraphAdditGain']
+            scale[i]=factor
+            offset[i]=ADCInfo['fInstrumentOffset']-ADCInfo['fSignalOffset']
+        return scale,offset
+
+    def raw(self,sweep=0,channel=0):
+        """return a zero-copy view of the unscaled samples of one sweep."""
+        return self.data[sweep,:,channel]
+
+    def scaled(self,raw,channel=0,dtype=float):
+        """
+        convert raw samples of a channel to real units (mV or pA).
+        Floating point files are already scaled so the same view comes back.
+        Integer files are scaled into one new array of the given dtype.
+        """
+        if self.dtype.kind=='f':
+            return raw
+        data=np.multiply(np.asarray(raw),self.scale[channel],dtype=dtype) # not a memmap
+        data+=self.offset[channel]
+        return data
+
+    def sweep(self,sweep=0,channel=0,dtype=float):
+        """return the data of a sweep in real units (mV or pA)."""
+        return self.scaled(self.raw(sweep,channel),channel,dtype)
+
+    def matrix(self,channel=0,I1=None,I2=None,dtype=float):
+        """
+        return a 2D array (sweeps x points) of a channel in real units,
+        optionally limited to the points between indexes I1 and I2.
+        For floating point files this is a strided view of the file.
+        """
+        return self.scaled(self.data[:,I1:I2,channel],channel,dtype)
+
+    def stack(self,I1=None,I2=None,dtype=float):
+        """
+        return every channel as a 3D array (channels x sweeps x points) in
+        real units, optionally limited to the points between I1 and I2.
+        For floating point files this is a strided view of the file.
+        """
+        data=self.data[:,I1:I2].transpose(2,0,1)
+        if self.dtype.kind=='f':
+            return data
+        data=np.multiply(np.asarray(data),self.scale[:,None,None],dtype=dtype)
+        data+=self.offset[:,None,None]
+        return data
+
+    def close(self):
+        """drop the memory map. The file is released once no views remain."""
+        self.data=None
+
+### integrity checks
+
+def checkABF(fname,checksum=False):
+    """
+    Check that an ABF is intact without decoding its data. The header must
+    parse, every header section and the data section must lie within the
+    file, and the data must divide into the number of sweeps the header
+    claims (or, for variable length event-driven recordings, match the
+    sweep lengths in the synch array). If checksum is True the whole file is read sequentially and its
+    MD5 is reported (which also proves every byte can be read).
+
+    Returns a dict: path, ok, problems (list of strings), bytes, sweeps,
+    channels, and md5 (None unless checksum is True).
+    """
+    result={"path":os.path.abspath(fname),"ok":False,"problems":[],
+            "bytes":0,"sweeps":0,"channels":0,"md5":None}
+    problems=result["problems"]
+    try:
+        result["bytes"]=fileSize=os.path.getsize(fname)
+        header=readHeader(fname)
+    except Exception as e:
+        problems.append("can't read header (%s)"%e)
+        return result
+    if fileSize<BLOCKSIZE:
+        problems.append("file is smaller than a header")
+    for name,section in header.get('sections',{}).items():
+        end=section['uBlockIndex']*BLOCKSIZE+section['uBytes']*section['llNumEntries']
+        if name!='DataSection' and section['llNumEntries'] and end>fileSize:
+            problems.append("%s extends beyond the end of the file"%name)
+    channels,points=header['channels'],header['dataPoints']
+    bytesPerPoint=header['dataBytesPerPoint']
+    result["channels"]=channels
+    if not channels:
+        problems.append("no ADC channels")
+    if not np.isfinite(header['rate']) or header['rate']<=0:
+        problems.append("bad sample rate")
+    if not bytesPerPoint in [2,4]:
+        problems.append("unsupported data format")
+    if header['dataOffset']<BLOCKSIZE:
+        problems.append("data section overlaps the header")
+    dataEnd=header['dataOffset']+points*bytesPerPoint
+    if dataEnd>fileSize:
+        problems.append("truncated: data section needs %d bytes but the file has %d"%(
+                        dataEnd,fileSize))
+    mode=header['protocol'].get('nOperationMode')
+    episodic=mode!=3 and header['lActualEpisodes']
+    sweeps=header['lActualEpisodes'] if episodic else 1
+    result["sweeps"]=sweeps
+    if episodic and mode==1: # variable length sweeps, the synch array has their lengths
+        lengths=header['synchArray']['lLength'].astype(float)
+        synchTimeUnit=header['protocol'].get('fSynchTimeUnit',0)
+        if synchTimeUnit: # lengths are in synch time units, not samples
+            lengths=np.round(lengths/synchTimeUnit)
+        lengths=lengths.astype(int)
+        if len(lengths)!=sweeps:
+            problems.append("%d sweeps but %d synch array entries"%(sweeps,len(lengths)))
+        elif lengths.sum()!=points:
+            problems.append("synch array sweeps need %d points, not %d"%(
+                            lengths.sum(),points))
+        elif channels and np.any(lengths%channels):
+            problems.append("sweep lengths don't divide into %d channels"%channels)
+    elif channels and points%(sweeps*channels):
+        problems.append("%d points don't divide into %d sweeps of %d channels"%(
+                        points,sweeps,channels))
+    perSweep=header['protocol'].get('lNumSamplesPerEpisode',0)
+    if episodic and mode in FIXED_LENGTH_MODES and perSweep and points!=sweeps*perSweep:
+        problems.append("%d sweeps of %d points need %d points, not %d"%(
+                        sweeps,perSweep,sweeps*perSweep,points))
+    if checksum:
+        md5=hashlib.md5()
+        try:
+            with open(fname,'rb') as f:
+                for chunk in iter(lambda: f.read(READ_BYTES),b''):
+                    md5.update(chunk)
+            result["md5"]=md5.hexdigest()
+        except OSError as e:
+            problems.append("can't read the whole file (%s)"%e)
+    result["ok"]=not problems
+    return result
+
+def validate(paths,workers=4,checksum=False):
+    """
+    Check many ABFs (see checkABF) in parallel and return a list of results
+    in the same order. paths can be a filename, a folder (every ABF in it is
+    checked), or a list of either. Reading is I/O bound, so workers threads
+    keep several files (on a network drive especially) in flight at once.
+    """
+    if isinstance(paths,str):
+        paths=[paths]
+    fnames=[]
+    for path in paths:
+        if os.path.isdir(path):
+            fnames.extend(sorted(glob.glob(os.path.join(path,"*.abf"))))
+        else:
+            fnames.append(path)
+    if workers<=1 or len(fnames)<2:
+        return [checkABF(x,checksum) for x in fnames]
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(lambda x: checkABF(x,checksum),fnames))
@@ -1,6 +1,9 @@
 # script to stress test the X-Drive
 import os
+import sys
 import time
+import glob
+import tempfile
 
 path_big_file=R"X:\Data\SCOTT\2017-05-10 GCaMP6f\GCaMP6f PFC GABA cre\2017-05-10-23 misc\2017-05-11 cell3_annotated.tif"
 path_path_to_walk=R"X:\Data\DIC2\2014"
@@ -38,7 +41,38 @@ def test_copying(path,runs=5):
     print("Average time for %d runs: %.03f seconds"%(runs,sum(times)/len(times)))
     return
 
+def test_abfCache(path,localFolder=None,runs=5):
+    """
+    time reading every sweep of every ABF in a folder with the local ABF
+    cache (swhlab.cache.localCopy). The first run is cold (nothing cached),
+    the rest are warm. Point path at a local folder to simulate the share.
+    """
+    sys.path.insert(0,os.path.abspath('../../'))
+    import swhlab
+    localFolder=localFolder or tempfile.mkdtemp()
+    fnames=sorted(glob.glob(os.path.join(path,"*.abf")))
+    for fname in fnames: # start cold
+        for fnameLocal in swhlab.cache.localPaths(fname,localFolder):
+            swhlab.cache.remove(fnameLocal)
+    print("reading %d ABFs in %s (cache: %s)"%(len(fnames),path,localFolder))
+    times=[]
+    for run in range(runs):
+        t1=timeIt()
+        mb=0
+        for fname in fnames:
+            abf=swhlab.ABF(fname,copyTo=localFolder)
+            for sweep in range(abf.sweeps):
+                mb+=abf.sweepData(sweep).nbytes/1024/1024
+        times.append(timeIt(t1))
+        print("(%d/%d) %s read took %.03f seconds (%.03f MB/s)"%(run+1,runs,
+              "cold" if run==0 else "warm",times[-1],mb/times[-1]))
+    if runs>1:
+        print("cold: %.03f seconds, warm average: %.03f seconds"%(times[0],
+              sum(times[1:])/(runs-1)))
+    return times
+
 if __name__=="__main__":
     test_listing(path_path_to_walk)
     test_copying(path_big_file)
+    test_abfCache(os.path.dirname(path_big_file))
     print("DONE")
\ No newline at end of file
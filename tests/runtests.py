@@ -6,12 +6,32 @@ import numpy as np
 import unittest
 import os
 import shutil
+import weakref
+import gc
 import webbrowser
 import matplotlib.pyplot as plt
 import sys
 
 testAbfPath='./abfs/gain.abf'
 
+def eventDrivenCopy(fname,lengths=[50000,70000,60000]):
+    """copy the test ABF, making it variable length event-driven (mode 1)."""
+    shutil.copy(testAbfPath,fname)
+    synch=swhlab.reader.readHeader(fname)['sections']['SynchArraySection']
+    with open(fname,'r+b') as f:
+        f.seek(512) # protocol section
+        f.write(np.array([1],dtype='<i2').tobytes()) # variable length mode
+        f.seek(512+14)
+        f.write(np.array([0],dtype='<f4').tobytes()) # synch array is in samples
+        f.seek(512+22)
+        f.write(np.array([max(lengths)],dtype='<i4').tobytes()) # longest sweep
+        f.seek(synch['uBlockIndex']*512)
+        starts=np.frombuffer(f.read(8*len(lengths)),dtype=swhlab.reader.SYNCH_DTYPE)['lStart']
+        synchArray=np.array(list(zip(starts,lengths)),dtype=swhlab.reader.SYNCH_DTYPE)
+        f.seek(synch['uBlockIndex']*512)
+        f.write(synchArray.tobytes())
+    return fname
+
 HTML_TEMPLATE="""<html><head><style>
 
 img{
@@ -83,7 +103,502 @@ class TEST_01_core(unittest.TestCase):
         abf.derivative=True
         abf.setsweep(1)
         assert len(abf.sweepD)>100
-        
+
+    def test_0060_nativeReader(self):
+        """the native reader should serve sweeps as views of the file."""
+        abf=swhlab.ABF(testAbfPath)
+        assert abf.backend=="native"
+        reader=swhlab.reader.ABFreader(testAbfPath)
+        assert reader.data.shape==(abf.sweeps,abf.sweepSize,abf.channels)
+        abf.setsweep(1)
+        assert np.array_equal(abf.sweepY,reader.sweep(1))
+        assert abf.header['dictEpochInfoPerDAC'][0]
+        import tempfile
+        folder=tempfile.mkdtemp()
+        try:
+            eventDriven=eventDrivenCopy(os.path.join(folder,"eventDriven.abf"))
+            self.assertRaises(ValueError,swhlab.reader.ABFreader,eventDriven)
+            for lazy in [False,True]: # falls back to neo either way
+                abf=swhlab.ABF(eventDriven,lazy=lazy)
+                assert abf.backend=="neo"
+                assert [len(abf.sweepData(x)) for x in range(3)]==[50000,70000,60000]
+        finally:
+            shutil.rmtree(folder,ignore_errors=True)
+        neo=swhlab.ABF(testAbfPath,backend="neo")
+        assert np.allclose(neo.sweepMatrix(),swhlab.ABF(testAbfPath).sweepMatrix())
+
+    def test_0070_lazy(self):
+        """lazy ABFs decode sweeps on demand and remember a few of them."""
+        abf=swhlab.ABF(testAbfPath,lazy=True)
+        assert len(abf.sweepCache)==1 # only the first sweep
+        for sweep in abf.setsweeps():
+            assert (sweep,0) in abf.sweepCache
+        assert len(abf.sweepCache)<=swhlab.core.LAZY_SWEEPS
+
+    def test_0080_header(self):
+        """header-only access should agree with a fully loaded ABF."""
+        abf=swhlab.ABF(testAbfPath)
+        header=swhlab.ABFHeader(testAbfPath)
+        assert header.protocol==abf.protocomment
+        assert header.sweeps==abf.sweeps
+        assert header.rate==abf.rate
+        assert header.holding==abf.holding
+        assert header.sweepPoints==abf.sweepSize
+        assert header.adcUnits==abf.channelUnits and header.dacUnits[0]=="pA"
+        raw=b'SSCH'+np.array([1,4,64,9,0,0,0,0,0,0],dtype='<i4').tobytes()
+        raw+=b'pro\x00mV\x00\x00\x00'+b'\x00'*10 # the last 2 strings are empty
+        assert swhlab.reader._indexedStrings(raw)==['','pro','mV','','']
+
+    def test_0090_sweepMatrix(self):
+        """the sweep matrix should match sweeps pulled one at a time."""
+        abf=swhlab.ABF(testAbfPath)
+        matrix=abf.sweepMatrix()
+        assert matrix.shape==(abf.sweeps,abf.sweepSize)
+        for sweep in abf.setsweeps():
+            assert np.array_equal(matrix[sweep],abf.sweepY)
+        assert abf.sweepMatrix(t1=.5,t2=1).shape[1]==int(.5*abf.pointsPerSec)
+        lazy=swhlab.ABF(testAbfPath,lazy=True,backend="neo")
+        assert np.allclose(lazy.sweepMatrix(),matrix)
+        assert np.allclose(abf.averageSweep(),np.mean(matrix,axis=0))
+
+    def test_0100_getSweep(self):
+        """getSweep() shouldn't change the ABF and should match setsweep()."""
+        abf=swhlab.ABF(testAbfPath)
+        abf.derivative=True
+        abf.setsweep(1)
+        sweep=abf.getSweep(-1)
+        assert sweep.sweep==abf.sweeps-1 and abf.sweep==1
+        assert sweep.Y.flags.writeable==False
+        abf.setsweep(sweep.sweep)
+        assert np.array_equal(sweep.Y,abf.sweepY)
+        assert np.allclose(sweep.D,abf.sweepD)
+        assert np.allclose(sweep.T,abf.sweepT)
+        abf.sweepY[:]=0 # editing sweepY is allowed, but shouldn't change anything else
+        assert np.array_equal(sweep.Y,abf.currentSweep.Y) and np.any(sweep.Y)
+        assert np.array_equal(abf.getSweep(sweep.sweep).Y,sweep.Y)
+        lazy=swhlab.ABF(testAbfPath,lazy=True) # sweepY copies the cached sweep
+        assert not np.shares_memory(lazy.sweepY,lazy.sweepData(lazy.sweep))
+        assert not np.shares_memory(abf.sweepY,abf.ABFreader.data) # float file
+        raw=swhlab.ABF(testAbfPath,dtype="int16") # sweeps are scaled just for us
+        raw.setsweep(1)
+        assert raw.sweepY.flags.owndata and raw.sweepCurrent is None
+        assert not np.shares_memory(raw.sweepY,raw.currentSweep.Y)
+        assert np.array_equal(raw.sweepY,raw.currentSweep.Y)
+        self.assertRaises(IndexError,abf.getSweep,abf.sweeps)
+
+    def test_0110_multichannel(self):
+        """the channel stack should hold every channel's sweep matrix."""
+        abf=swhlab.ABF(testAbfPath)
+        stack=abf.sweepStack()
+        assert stack.shape==(abf.channels,abf.sweeps,abf.sweepSize)
+        for channel in range(abf.channels):
+            assert np.array_equal(stack[channel],abf.sweepMatrix(channel))
+        averages=abf.channelAverages(1,2)
+        abf.setsweep(1)
+        assert np.isclose(averages[abf.channel,1],abf.average(1,2))
+        lazy=swhlab.ABF(testAbfPath,lazy=True,backend="neo")
+        assert np.allclose(lazy.sweepStack(),stack)
+
+    def test_0120_diskCache(self):
+        """cached sweeps should match decoded ones and invalidate on change."""
+        abf=swhlab.ABF(testAbfPath,backend="neo",lazy=True,cache=True)
+        fnames=swhlab.cache.cachePaths(abf)
+        try:
+            assert abf.diskCache is not None
+            assert os.path.exists(fnames[0]) and os.path.exists(fnames[1])
+            again=swhlab.ABF(testAbfPath,backend="neo",lazy=True,cache=True)
+            assert isinstance(again.diskCache,np.memmap)
+            assert np.allclose(again.sweepStack(),swhlab.ABF(testAbfPath).sweepStack())
+            with open(fnames[1]) as f:
+                meta=swhlab.cache.json.load(f)
+            meta['key']['mtime']=0 # pretend the ABF was modified
+            with open(fnames[1],'w') as f:
+                swhlab.cache.json.dump(meta,f)
+            assert swhlab.cache.load(abf) is None
+            assert not os.path.exists(fnames[0])
+        finally:
+            for fname in fnames:
+                swhlab.cache.remove(fname)
+
+    def test_0130_cachedABF(self):
+        """cached ABFs should be opened once, but cloned for each caller."""
+        abf1=swhlab.core.cachedABF(testAbfPath)
+        abf2=swhlab.core.cachedABF(os.path.relpath(testAbfPath))
+        assert abf1 is not abf2 and abf1.master is abf2.master
+        assert np.shares_memory(abf1.ABFreader.data,abf2.ABFreader.data)
+        abf1.setsweep(1)
+        assert abf2.sweep==0
+        assert swhlab.core.cachedABF(abf1).sweep==1
+
+    def test_0135_cachedABFclones(self):
+        """clones should keep their master alive and share its caches, not its state."""
+        maxItems=swhlab.core.ABF_CACHE
+        try:
+            swhlab.core.ABF_CACHE=1
+            abf1=swhlab.core.cachedABF(testAbfPath,lazy=True)
+            master=weakref.ref(abf1.master)
+            swhlab.core.cachedABF(testAbfPath,dtype="float32") # evicts it
+            gc.collect()
+            assert master() is not None
+            assert swhlab.core.cachedABF(testAbfPath,lazy=True).master is master()
+            del abf1
+            swhlab.core.cachedABF(testAbfPath,dtype="float32")
+            gc.collect()
+            assert master() is None # nobody uses it now
+        finally:
+            swhlab.core.ABF_CACHE=maxItems
+        abf1=swhlab.core.cachedABF(testAbfPath,lazy=True)
+        abf2=swhlab.core.cachedABF(testAbfPath,lazy=True)
+        abf1.setsweep(2) # decoded once, and shared (read-only) with other clones
+        assert abf2.sweepData(2) is abf1.sweepData(2)
+        assert not abf2.sweepData(2).flags.writeable
+        assert abf1.derived("derivative",1) is abf2.derived("derivative",1)
+        abf1.sweepY[:]=0
+        assert np.any(abf2.sweepY) and abf1.currentSweep.abf is abf1
+        self.assertRaises(ValueError,abf1.ABFreader.data.fill,0)
+
+    def test_0140_reducedPrecision(self):
+        """float32 and raw ABFs should give the same data in less memory."""
+        abf=swhlab.ABF(testAbfPath)
+        for backend in ["native","neo"]:
+            for dtype in ["float32","int16"]:
+                small=swhlab.ABF(testAbfPath,backend=backend,lazy=True,dtype=dtype)
+                assert small.sweepY.dtype==np.float32
+                assert np.allclose(small.sweepY,abf.sweepY)
+                assert np.allclose(small.averageSweep(),abf.averageSweep())
+                assert np.allclose(small.channelAverages(1,2),abf.channelAverages(1,2))
+                assert small.sweepMatrix(scaled=False).itemsize<=4
+                assert small.getSweep(1).D.dtype==np.float32
+
+    def test_0150_iterChunks(self):
+        """chunks should rebuild the recording, and filter like it too."""
+        abf=swhlab.ABF(testAbfPath,lazy=True,backend="neo")
+        whole=abf.sweepMatrix().flatten()
+        kernel=abf.kernel_gaussian(sizeMS=50)
+        chunks=list(abf.iterChunks(seconds=.7,overlap=.1))
+        assert len(chunks)==int(np.ceil(len(whole)/(.7*abf.pointsPerSec)))
+        assert np.array_equal(np.concatenate([x.trim() for x in chunks]),whole)
+        filtered=[x.trim(swhlab.common.convolve(x.Y,kernel)) for x in chunks]
+        assert np.allclose(np.concatenate(filtered),swhlab.common.convolve(whole,kernel))
+        assert chunks[1].recordingIndex([0,chunks[1].pre])[0]==chunks[1].I
+
+    def test_0160_derived(self):
+        """derived signals should be cached and match per-sweep results."""
+        abf=swhlab.ABF(testAbfPath)
+        bulk=abf.derived("derivative")
+        assert bulk.shape==(abf.sweeps,abf.sweepSize)
+        assert abf.getSweep(1).D is abf.derived("derivative",1)
+        abf.derivative=True
+        abf.setsweep(2)
+        assert np.array_equal(abf.sweepD,bulk[2])
+        filtered=abf.derived("filtered",sizeMS=5)
+        assert np.allclose(filtered[1],abf.derived("filtered",1,sizeMS=5))
+        baseline=abf.derived("baseline",0,t1=0,t2=.1)
+        assert abs(np.mean(baseline[:int(.1*abf.pointsPerSec)]))<1e-3
+        self.assertRaises(ValueError,abf.derived,"nonsense")
+
+    def test_0170_commandWaveform(self):
+        """the command matrix should agree with the protocol of each sweep."""
+        abf=swhlab.ABF(testAbfPath)
+        command=abf.commandMatrix()
+        assert command.shape==(abf.sweeps,abf.sweepSize)
+        for sweep in range(abf.sweeps):
+            X,Y=abf.get_protocol_sequence(sweep)
+            for i in range(len(X)-1):
+                assert np.all(command[sweep,int(X[i]):int(X[i+1])]==Y[i])
+        timePoint=abf.protoSeqX[2]/abf.pointsPerSec
+        assert np.array_equal(abf.clamp_values(timePoint),command[:,abf.protoSeqX[2]])
+        assert abf.commandValues(timePoint,sweep=1)==command[1,abf.protoSeqX[2]]
+
+    def test_0180_envelope(self):
+        """the envelope should have the same extremes as the data it covers."""
+        abf=swhlab.ABF(testAbfPath)
+        whole=abf.sweepMatrix().flatten()
+        T,Ymin,Ymax=abf.envelope(pixels=500)
+        assert len(T)==500 and np.all(np.diff(T)>0)
+        assert np.min(Ymin)==np.min(whole) and np.max(Ymax)==np.max(whole)
+        I=int(T[100]*abf.pointsPerSec)
+        assert Ymin[100]<=whole[I]<=Ymax[100]
+        T,Ymin,Ymax=abf.envelope(1,1.01,pixels=1000) # fewer points than pixels
+        assert Ymin is Ymax and len(T)==int(.01*abf.pointsPerSec)
+        levels=abf.pyramid()
+        assert levels[0][0]==swhlab.core.PYRAMID_BLOCK
+        assert len(levels[0][1])==np.ceil(len(whole)/levels[0][0])
+
+    def test_0190_prefetch(self):
+        """prefetched sweeps should match, and the thread should clean up."""
+        import threading
+        abf=swhlab.ABF(testAbfPath,lazy=True,backend="neo")
+        expected=[abf.sweepData(x).copy() for x in range(abf.sweeps)]
+        threads=threading.active_count()
+        for sweep in abf.setsweeps(prefetch=2):
+            assert np.array_equal(abf.sweepY,expected[sweep])
+        for sweep in abf.setsweeps(prefetch=1):
+            break # stopping early shouldn't leave anything behind
+        assert threading.active_count()==threads
+        assert len(abf.prefetched)==0
+
+    def test_0200_importTime(self):
+        """importing swhlab (or reading a header) shouldn't import plotting or neo."""
+        import subprocess
+        script=("import sys; sys.path.insert(0,'../'); heavy=['matplotlib','neo'];"
+                "import swhlab; print([x for x in heavy if x in sys.modules]);"
+                "swhlab.ABFHeader('%s'); print([x for x in heavy if x in sys.modules])"
+                %testAbfPath)
+        output=subprocess.check_output([sys.executable,'-c',script])
+        afterImport,afterHeader=output.decode().strip().split("\n")[-2:]
+        assert afterImport=="[]", afterImport
+        assert afterHeader=="[]", afterHeader
+
+    def test_0210_tagIndex(self):
+        """tag lookups should find the right tags and sweeps."""
+        abf=swhlab.ABF(testAbfPath)
+        assert len(abf.tags)==0 and len(abf.tags.between(0,100))==0
+        tags=swhlab.core.TagIndex([7.5,0.2,4.1],["c","a","b"],[0,3,6])
+        assert tags.text==["a","b","c"] and list(tags.sweeps)==[0,1,2]
+        assert list(tags.between(0,5))==[0,1]
+        assert list(tags.between(4.1,7.5))==[1,2]
+        assert list(tags.epochSweeps(0))==[0] and list(tags.epochSweeps(2))==[2]
+        assert list(tags.sweepWindow(1,1))==[0,1,2]
+        assert list(tags.sweepWindow(0,5))==[0,1,2]
+        assert tags.epochOfSweep(1)==1 and tags.epochOfSweep(2)==2
+        gaps=swhlab.core.TagIndex([1,12,17,31,99],list("abcde"),[0,10,20,30])
+        assert list(gaps.sweeps)==[0,1,1,3,3] # a tag in a gap belongs to the sweep before it
+        assert list(gaps.epochSweeps(0))==[0] and list(gaps.epochSweeps(2))==[1,2]
+        assert gaps.epochOfSweep(2)==2
+
+    def test_0220_localCache(self):
+        """ABFs should be read from a local copy which tracks the original."""
+        import tempfile, glob
+        folder=tempfile.mkdtemp()
+        try:
+            remote=os.path.join(folder,"share","remote.abf")
+            local=os.path.join(folder,"local")
+            os.mkdir(os.path.dirname(remote))
+            shutil.copy(testAbfPath,remote)
+            abf=swhlab.ABF(remote,copyTo=local)
+            assert abf.localFilename!=abf.filename
+            assert abf.filename==os.path.abspath(remote)
+            assert os.path.dirname(abf.localFilename)==os.path.abspath(local)
+            original=swhlab.ABF(testAbfPath)
+            assert np.array_equal(abf.sweepData(2),original.sweepData(2))
+            copied=os.path.getmtime(abf.localFilename)
+            del abf
+            again=swhlab.ABF(remote,copyTo=local)
+            assert os.path.getmtime(again.localFilename)==copied # warm
+            del again
+            os.utime(remote,(1e9,1e9)) # the original changed
+            swhlab.ABF(remote,copyTo=local)
+            assert os.path.getmtime(swhlab.cache.localPaths(remote,local)[0])!=copied
+            both=swhlab.ABF(remote,copyTo=local,backend="neo",cache=True)
+            assert both.diskCache is not None # cache= still means the disk cache
+            assert np.array_equal(both.sweepData(2),original.sweepData(2))
+            del both
+            limit=swhlab.cache.LOCAL_MB
+            try:
+                swhlab.cache.LOCAL_MB=1.5*os.path.getsize(remote)/1e6
+                shutil.copy(testAbfPath,remote.replace("remote","other"))
+                swhlab.ABF(remote.replace("remote","other"),copyTo=local)
+                assert len(glob.glob(os.path.join(local,"*.abf")))==1 # evicted
+            finally:
+                swhlab.cache.LOCAL_MB=limit
+        finally:
+            shutil.rmtree(folder,ignore_errors=True)
+
+    def test_0230_validate(self):
+        """validate() should pass good ABFs and catch truncated ones."""
+        import tempfile
+        folder=tempfile.mkdtemp()
+        try:
+            truncated=os.path.join(folder,"truncated.abf")
+            shutil.copy(testAbfPath,truncated)
+            with open(truncated,'r+b') as f:
+                f.truncate(os.path.getsize(testAbfPath)//2)
+            junk=os.path.join(folder,"junk.abf")
+            with open(junk,'wb') as f:
+                f.write(b"not an ABF")
+            results=swhlab.validate([testAbfPath,folder],workers=2,checksum=True)
+            assert [x["ok"] for x in results]==[True,False,False]
+            assert results[0]["sweeps"]==swhlab.ABF(testAbfPath).sweeps
+            assert len(results[0]["md5"])==32
+            assert "truncated" in " ".join(results[2]["problems"])
+            eventDriven=eventDrivenCopy(os.path.join(folder,"eventDriven.abf"))
+            synch=swhlab.reader.readHeader(testAbfPath)['sections']['SynchArraySection']
+            assert swhlab.reader.checkABF(eventDriven)["ok"]
+            with open(eventDriven,'r+b') as f:
+                f.seek(synch['uBlockIndex']*512+4)
+                f.write(np.array([40000],dtype='<i4').tobytes())
+            assert not swhlab.reader.checkABF(eventDriven)["ok"]
+            with open(eventDriven,'r+b') as f: # synch array in 12.5 us units
+                f.seek(512+14)
+                f.write(np.array([12.5],dtype='<f4').tobytes())
+                f.seek(synch['uBlockIndex']*512)
+                synchArray=np.frombuffer(f.read(24),dtype=swhlab.reader.SYNCH_DTYPE).copy()
+                synchArray['lLength']=np.array([50000,70000,60000])*12.5
+                f.seek(synch['uBlockIndex']*512)
+                f.write(synchArray.tobytes())
+            assert swhlab.reader.checkABF(eventDriven)["ok"]
+        finally:
+            shutil.rmtree(folder,ignore_errors=True)
+
+    def test_0240_slice(self):
+        """slices should span sweeps, follow real sweep times, and be views."""
+        abf=swhlab.ABF(testAbfPath)
+        start=abf.sweepStarts[0]
+        T,Y=abf.slice(start+2.5,start+4)
+        assert len(T)==len(Y)==int(1.5*abf.pointsPerSec)
+        assert np.isclose(T[0],start+2.5)
+        assert np.shares_memory(Y,abf.ABFreader.data) # not a copy
+        assert np.array_equal(Y[:abf.pointsPerSec//2],abf.sweepData(0)[-abf.pointsPerSec//2:])
+        assert np.array_equal(Y[abf.pointsPerSec//2:],abf.sweepData(1)[:abf.pointsPerSec])
+        abf.sweepStarts=np.arange(abf.sweeps)*(abf.sweepLength+1) # 1 sec gaps
+        T,Y=abf.slice(2,5)
+        assert np.isclose(T[0],2) and np.isclose(T[-1],4.99995)
+        assert len(Y)==abf.pointsPerSec*2 # the gap has no points
+        assert np.array_equal(Y[-abf.pointsPerSec:],abf.sweepData(1)[:abf.pointsPerSec])
+        lazy=swhlab.ABF(testAbfPath,lazy=True,backend="neo")
+        lazy.sweepStarts=abf.sweepStarts
+        assert np.allclose(lazy.slice(2,5)[1],Y)
+        import tempfile, struct
+        folder=tempfile.mkdtemp()
+        try: # relabel the data as int16 samples, which get scaled on the fly
+            integer=os.path.join(folder,"integer.abf")
+            shutil.copy(testAbfPath,integer)
+            with open(integer,'r+b') as f:
+                section=76+10*16 # DataSection
+                block,size,count=struct.unpack_from('<IIq',f.read(512),section)
+                f.seek(section)
+                f.write(struct.pack('<IIq',block,2,count))
+            integer=swhlab.ABF(integer)
+            assert integer.ABFreader.dtype==np.int16
+            whole=np.concatenate([integer.sweepData(x) for x in range(integer.sweeps)])
+            assert np.array_equal(integer.recordingData(50000,130000),whole[50000:130000])
+        finally:
+            shutil.rmtree(folder,ignore_errors=True)
+
+    def test_0250_lazyTimes(self):
+        """sweep time arrays should be made on demand and shared by sweeps."""
+        abf=swhlab.ABF(testAbfPath)
+        X2=abf.sweepX2
+        abf.setsweep(2)
+        assert abf.sweepX2 is X2 and abf.getSweep(1).X2 is X2
+        assert not 'sweepX' in abf.__dict__ # not made until it's used
+        assert np.allclose(abf.sweepX,X2+2*abf.sweepLength)
+        assert np.allclose(abf.sweepT,X2+abf.sweepStarts[2])
+        assert abf.sweepX is abf.sweepX # made once per sweep
+
+    def test_0260_sweepStats(self):
+        """sweep statistics should agree with numpy, streamed or not."""
+        abf=swhlab.ABF(testAbfPath)
+        matrix=abf.sweepMatrix(t1=.5,t2=1).astype(float)
+        for ABF in [abf,swhlab.ABF(testAbfPath,lazy=True,backend="neo")]:
+            stats=ABF.sweepStats(t1=.5,t2=1)
+            assert np.allclose(stats["mean"],np.mean(matrix,axis=0))
+            assert np.allclose(stats["sd"],np.std(matrix,axis=0,ddof=1))
+            assert np.allclose(stats["sem"],stats["sd"]/np.sqrt(abf.sweeps))
+            assert np.allclose(stats["max"],np.max(matrix,axis=0))
+            assert np.isclose(stats["X"][0],.5) and np.all(stats["count"]==abf.sweeps)
+        weights=[1,2,.5]
+        stats=abf.sweepStats(t1=.5,t2=1,baseline=(0,.1),weights=weights)
+        baselined=matrix-np.mean(abf.sweepMatrix(t2=.1),axis=1,dtype=float)[:,None]
+        assert np.allclose(stats["mean"],np.average(baselined,axis=0,weights=weights))
+        blockSize=swhlab.core.STATS_POINTS
+        try:
+            swhlab.core.STATS_POINTS=777 # blocks which don't divide the range
+            blocked=abf.sweepStats(t1=.5,t2=1,baseline=(0,.1),weights=weights)
+        finally:
+            swhlab.core.STATS_POINTS=blockSize
+        for key in ["mean","sd","min","max","count"]:
+            assert np.allclose(blocked[key],stats[key])
+        lazy=swhlab.ABF(testAbfPath,lazy=True,backend="neo")
+        blanked=lazy.sweepData(1).copy()
+        blanked[:100]=np.nan
+        lazy.sweepCache[(1,0)]=blanked
+        stats=lazy.sweepStats(t2=.01)
+        assert list(stats["count"][[0,150]])==[2,3]
+        assert np.allclose(stats["mean"][0],np.mean(abf.sweepMatrix()[[0,2],0]))
+
+    def test_0270_measure(self):
+        """batched measurements should match measuring sweeps one at a time."""
+        abf=swhlab.ABF(testAbfPath)
+        ranges=[(0,.1),(.5,1),(2,None),(99,100)]
+        stats=["mean","std","min","max","area","peak","slope"]
+        values,labels=abf.measure(ranges,stats)
+        assert values.shape==(abf.sweeps,len(ranges),len(stats))
+        assert labels["stats"]==stats and labels["ranges"][2]==(2,abf.sweepLength)
+        assert np.all(np.isnan(values[:,3])) # no points in that range
+        for sweep in abf.setsweeps():
+            Y=abf.sweepY[int(.5*abf.pointsPerSec):abf.pointsPerSec].astype(float)
+            T=np.arange(len(Y))/abf.rate
+            expected=[np.mean(Y),np.std(Y),np.min(Y),np.max(Y),np.sum(Y)/abf.rate,
+                      Y[np.argmax(np.abs(Y))],np.polyfit(T,Y,1)[0]]
+            assert np.allclose(values[sweep,1],expected)
+            assert np.isclose(values[sweep,2,0],abf.average(2))
+        lazy=swhlab.ABF(testAbfPath,lazy=True,backend="neo",dtype="int16")
+        assert np.allclose(lazy.measure(ranges,stats)[0],values,equal_nan=True)
+        start,labels=abf.measure([(None,.1)],["mean"])
+        assert np.allclose(start[:,0,0],values[:,0,0]) and labels["ranges"]==[(0,.1)]
+        self.assertRaises(ValueError,abf.measure,ranges,["nonsense"])
+
+    def test_0280_convolve(self):
+        """every convolution method should pad edges and agree with the others."""
+        matrix=swhlab.ABF(testAbfPath).sweepMatrix()[:,:5000]
+        for size in [1,10,101,3000,9000]:
+            kernel=swhlab.common.kernel_gaussian(size)
+            direct=swhlab.common.convolve(matrix,kernel,"direct")
+            assert direct.shape==matrix.shape
+            assert np.allclose(direct[1],swhlab.common.convolve(matrix[1],kernel))
+            for method in ["fft","overlap-add"]:
+                assert np.allclose(swhlab.common.convolve(matrix,kernel,method),direct)
+        flat=swhlab.common.convolve(np.full(500,3.0),swhlab.common.kernel_gaussian(100))
+        assert np.allclose(flat,3) # edges don't droop
+        self.assertRaises(ValueError,swhlab.common.convolve,flat,[1],"nonsense")
+
+    def test_0290_smoothBoxes(self):
+        """box filter cascades should blur like the gaussian kernels they replace."""
+        impulse=np.zeros(20001)
+        impulse[10000]=1
+        for sigma in [5,50,500]:
+            blurred=swhlab.common.smoothBoxes(impulse,sigma)
+            X=np.arange(len(blurred))-10000
+            assert np.isclose(np.sum(blurred),1) and abs(np.sum(blurred*X))<1e-6
+            assert abs(np.sqrt(np.sum(blurred*X**2))/sigma-1)<.05
+        assert np.allclose(swhlab.common.smoothBoxes(np.full(100,3.0),20),3)
+        abf=swhlab.ABF(testAbfPath)
+        abf.kernel_gaussian(sizeMS=100)
+        kernel,boxes=abf.sweepYfiltered(),abf.sweepYfiltered("boxes")
+        assert np.std(boxes-kernel)<.01*np.std(abf.sweepY)
+        filtered=abf.derived("filtered",sizeMS=100,smoother="boxes")
+        assert np.allclose(filtered[abf.sweep],boxes)
+        lowpass=swhlab.common.lowpass(abf.sweepY,2000,"boxes")
+        assert np.allclose(lowpass,swhlab.common.smoothBoxes(abf.sweepY,200))
+
+    def test_0300_kernelCache(self):
+        """gaussian kernels (and their FFTs) should be made once and reused."""
+        common=swhlab.common
+        kernel=common.kernel_gaussian(1000,100)
+        assert kernel is common.kernel_gaussian(1000.0,100)
+        assert kernel is not common.kernel_gaussian(1000,100,forwardOnly=True)
+        assert common.kernel_gaussian(1000,100,dtype=np.float32).dtype==np.float32
+        assert not kernel.flags.writeable
+        signal=np.random.RandomState(0).normal(size=50000)
+        common.spectrumCache.clear()
+        first=common.convolve(signal,kernel,"fft")
+        assert len(common.spectrumCache)==1
+        assert np.allclose(common.convolve(signal,kernel,"fft"),first)
+        assert len(common.spectrumCache)==1
+        assert np.allclose(common.convolve(signal,np.copy(kernel),"fft"),first)
+        assert np.allclose(common.convolve(signal,kernel,"overlap-add"),first)
+        assert len(common.spectrumCache)==2
+        maxItems=common.KERNEL_CACHE
+        try:
+            common.KERNEL_CACHE=2
+            for size in [10,20,30]:
+                common.kernel_gaussian(size)
+            assert len(common.kernelCache)==2
+        finally:
+            common.KERNEL_CACHE=maxItems
+
 class TEST_01_plot(unittest.TestCase):
     """only use functionality in core and plotting/core.py"""    
         